@@ -1,12 +1,20 @@
+import asyncio
 from commands import TeleCommands
 from config import Config
-from current import CurrentMonitor, CurrentType, current_combine
+from current import CurrentMonitor, CurrentType
 from datalogger import DataLogger
 from hysteresis import CarConnect, Misalignment, OnOff
 from pathlib import Path
+from query import History
 from quasar import Quasar
 from recommend import Recommend
-from state import Mode
+from runtime import Runtime
+from scheduler import Scheduler
+try:
+    from forecast import LoadForecast
+except ImportError:
+    # Without NumPy the Scheduler falls back to its flat forecast
+    LoadForecast = None
 
 NAMES = ['Solar', 'House', 'Car', 'Heat Pump', 'Grid']
 CURRENT_TYPES = [
@@ -21,6 +29,9 @@ QUASAR_ADDR = '192.168.1.74'
 if __name__ == '__main__':
     CONFIG = Config(Path("/home/pi/power_manager"), NAMES, CURRENT_TYPES,
                     30.6, 7.5, 0.8, (0, 0), (5, 30), 40, 80, 90, (23, 30))
+    data_logger = None
+    forecast = None
+    scheduler = None
     commands = None
     quasar = None
     try:
@@ -28,34 +39,31 @@ if __name__ == '__main__':
         quasar = Quasar(QUASAR_ADDR)
         commands = TeleCommands(CONFIG, data_logger, quasar)
         current_monitor = CurrentMonitor(len(NAMES))
-        recommend = Recommend(CONFIG)
+        if LoadForecast is not None:
+            forecast = LoadForecast(CURRENT_TYPES, CONFIG.path / Path('forecast.json'))
+            forecast.start_training(History(data_logger.folder))
+        scheduler = Scheduler(CONFIG, forecaster=forecast)
+        recommend = Recommend(CONFIG, scheduler)
         on_off_hysteresis = OnOff(4)
         car_connect_detection = CarConnect(10)
         misalignment_detection = Misalignment(10);
 
-        while True:
-            currents = current_monitor.read()
-            print(currents)
-            if currents[3] > commands.tbot.nvinfo.get_general('pump_threshold', 99):
-                currents[3] -= commands.tbot.nvinfo.get_general('pump_subtractor', 0)
-
-            estimated = current_combine(currents, CURRENT_TYPES)
-            recommended = recommend.current(estimated, commands.tbot.modes.state, quasar)
-            charge_rate = on_off_hysteresis.balance(recommended)
-
-            car_connect_detection.check(quasar, charge_rate, currents[2])
-            misalignment_detection.check(quasar, charge_rate, currents[2])
-
-            data_logger.tick(currents, recommended, commands.tbot.modes._mode, quasar.soc)
-            commands.tbot.update_info(currents, estimated, recommended, charge_rate)
-
-            if commands.tbot.modes.state != Mode.OFF:
-                quasar.set_charge_rate(charge_rate)
+        runtime = Runtime(CURRENT_TYPES, current_monitor, recommend, on_off_hysteresis,
+                          car_connect_detection, misalignment_detection, data_logger, quasar,
+                          commands)
+        commands.metrics = runtime.metrics
+        asyncio.run(runtime.run())
     except:  # noqa
         CONFIG.logger.exception('Overall:')
         raise
     finally:
+        if scheduler is not None:
+            scheduler.cleanup()
         if commands is not None:
             commands.cleanup()
         if quasar is not None:
             quasar.cleanup()
+        if data_logger is not None:
+            data_logger.cleanup()
+        if forecast is not None:
+            forecast.save()
@@ -0,0 +1,92 @@
+"""Array versions of the recommendation pipeline, for evaluating a lot of samples at once.
+
+Each function gives exactly what its scalar counterpart would for every element.
+"""
+from config import Config
+from datetime import datetime, timedelta
+from hysteresis import OnOff
+import numpy as np
+from state import Policy
+
+
+def current_combine(currents: np.ndarray, current_types: list) -> np.ndarray:
+    """current.current_combine for each row of a (samples, channels) array.
+
+    The channels are added in order so the rounding is the same as the scalar sum.
+    """
+    currents = np.asarray(currents, dtype=float)
+    total = np.zeros(len(currents))
+    for (i, ct) in enumerate(current_types):
+        total = total + currents[:, i] * ct.value[0]
+    return total
+
+
+def round_estimation(estimated: np.ndarray, frac, minimum=3) -> np.ndarray:
+    """Recommend.round_estimation for each estimate, frac and minimum can be arrays too."""
+    estimated = np.asarray(estimated, dtype=float)
+    positive = np.abs(estimated)
+    rounded = np.where(positive % 1 < frac, np.floor(positive), np.ceil(positive))
+    value = np.where(positive > minimum, rounded,
+                     np.where(positive >= np.multiply(frac, minimum), minimum, 0))
+    return np.where(estimated >= 0, -value, value).astype(int)
+
+
+def prices(config: Config, times: np.ndarray) -> np.ndarray:
+    """The tariff's rate at each of some epoch times."""
+    times = np.asarray(times, dtype=float)
+    if len(times) == 0:
+        return np.zeros(0)
+    start = datetime.fromtimestamp(times.min())
+    end = datetime.fromtimestamp(times.max()) + timedelta(minutes=1)
+    start = start.replace(second=0, microsecond=0)
+    schedule = config.tariff.changes(start, end)
+    edges = np.array([when.timestamp() for (when, _) in schedule])
+    rates = np.array([rate for (_, rate) in schedule])
+    return rates[np.searchsorted(edges, times, side='right') - 1]
+
+
+def charge_limits(policy: Policy, soc: np.ndarray) -> np.ndarray:
+    """Policy.charge_limit for each SoC."""
+    soc = np.asarray(soc)
+    i = np.searchsorted(policy._max_thresholds, soc, side='right')
+    values = np.array(policy._max_values + [policy.charge_cost_limit], dtype=float)
+    return np.where((soc != 0) & (i > 0), values[i - 1], policy.charge_cost_limit)
+
+
+def discharge_limits(policy: Policy, estimated: np.ndarray, soc: np.ndarray) -> np.ndarray:
+    """Policy.discharge_limit for each estimate and SoC."""
+    soc = np.asarray(soc)
+    i = np.searchsorted(policy._min_thresholds, soc, side='left')
+    values = np.array(policy._min_values + [policy.discharge_value], dtype=float)
+    default = np.where(np.asarray(estimated) < 3, policy.low_discharge_value,
+                       policy.discharge_value)
+    return np.where((soc != 0) & (i < len(policy._min_thresholds)), values[i], default)
+
+
+def recommend(estimated: np.ndarray, price: np.ndarray, soc: np.ndarray,
+              policy: Policy) -> np.ndarray:
+    """Recommend.current for each sample under one Policy, without a Scheduler.
+
+    AUTO's tracking of the SoC changes its policy as it goes, so that has to be replayed in
+    order with the scalar Recommend instead.
+    """
+    estimated = np.asarray(estimated, dtype=float)
+    price = np.asarray(price, dtype=float)
+    charge_limit = charge_limits(policy, soc)
+    discharge_value = discharge_limits(policy, estimated, soc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        surplus = round_estimation(estimated, 1 - np.minimum(charge_limit / price, 1), 3)
+        deficit = round_estimation(estimated, np.minimum(discharge_value / price, 1),
+                                   policy.min_discharge_rate)
+    deficit = np.where(price < discharge_value, 0, deficit)
+    return np.where(price < charge_limit, 32, np.where(estimated <= 0, surplus, deficit))
+
+
+def on_off(recommended: np.ndarray, count: int = 4) -> np.ndarray:
+    """Run hysteresis.OnOff over a sequence of recommendations from a fresh start.
+
+    Each output depends on the ones before, so this just feeds them through an OnOff in turn.
+    """
+    hysteresis = OnOff(count)
+    return np.array([hysteresis.balance(rec) for rec in np.asarray(recommended).tolist()],
+                    dtype=int)
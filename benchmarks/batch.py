@@ -0,0 +1,46 @@
+"""Time batch against the scalar pipeline on random samples.
+
+test_batch.py checks they give exactly the same. Run from the repository root with:
+    python -m benchmarks.batch
+"""
+import batch
+from config import Config
+from parity import TYPES, replay, samples
+from pathlib import Path
+from state import Mode
+import tempfile
+import time
+
+SETTINGS = [{}, {'charge_cost_limit': 8.0, 'discharge_value': 20.0, 'min_discharge_rate': 6},
+            {'charge_cost_limit': 10.0, 'max_paid_soc': 60, 'min_discharge_soc': 30}]
+
+
+def scalar(folder: Path, settings: dict, currents, times, socs) -> tuple:
+    start = time.perf_counter()
+    (out, config, policy) = replay(folder, Mode.CHARGE_DISCHARGE, settings, currents, times,
+                                   socs)
+    return (out, time.perf_counter() - start, config, policy)
+
+
+def vector(config: Config, policy, currents, times, socs) -> tuple:
+    start = time.perf_counter()
+    estimated = batch.current_combine(currents, TYPES)
+    price = batch.prices(config, times)
+    recommended = batch.recommend(estimated, price, socs, policy)
+    balanced = batch.on_off(recommended, 4)
+    return ((estimated, price, recommended, balanced), time.perf_counter() - start)
+
+
+def main(n: int = 200000):
+    (currents, times, socs) = samples(n)
+    for settings in SETTINGS:
+        with tempfile.TemporaryDirectory() as folder:
+            (_, scalar_secs, config, policy) = scalar(Path(folder), settings, currents, times,
+                                                      socs)
+        (_, vector_secs) = vector(config, policy, currents, times, socs)
+        print(f'{settings}: {n} samples, scalar {round(scalar_secs, 2)}s, \
+batch {round(vector_secs, 3)}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Time fitting and forecasting with forecast.Profile on synthetic data, and check its fit.
+
+Fitting is timed both a reading at a time, as the control loop does, and all at once, as
+training on the history does.
+
+Run from the repository root with: python -m benchmarks.forecast
+"""
+from datetime import datetime, timedelta
+from forecast import Profile, bucket
+from math import pi, sin
+import numpy as np
+import random
+from scheduler import FlatForecast
+import time
+
+SAMPLE_SECS = 15
+
+
+def load(when: datetime) -> float:
+    """A made up house load in kW with a daily shape, busier weekends and noise."""
+    hour = when.hour + when.minute / 60
+    weekend = 0.3 if when.weekday() >= 5 else 0.0
+    return 0.8 + weekend + 0.6 * max(sin((hour - 6) / 24 * 2 * pi), 0) + random.gauss(0, 0.2)
+
+
+def main(weeks: int = 8):
+    random.seed(0)
+    start = datetime(2022, 1, 3)
+    samples = [(start + timedelta(seconds=i * SAMPLE_SECS),)
+               for i in range(weeks * 7 * 24 * 3600 // SAMPLE_SECS)]
+    samples = [(when, load(when)) for (when,) in samples]
+    profile = Profile(1)
+    flat = FlatForecast()
+    begin = time.perf_counter()
+    for (when, kw) in samples:
+        profile.observe([kw], when)
+    fit = time.perf_counter() - begin
+    for (when, kw) in samples:
+        flat.observe([], kw / 0.24, when)
+    print(f'observe: {round(fit / len(samples) * 1e6, 2)}us per sample ({len(samples)} samples)')
+    buckets = np.array([bucket(when) for (when, _) in samples])
+    values = np.array([[kw] for (_, kw) in samples])
+    batch = Profile(1)
+    begin = time.perf_counter()
+    batch.fit(buckets, values, samples[-1][0])
+    fit = time.perf_counter() - begin
+    print(f'fit: {round(fit / len(samples) * 1e6, 3)}us per sample, profiles differ by at most \
+{np.abs(batch.profiles - profile.profiles).max():.2e}kW')
+
+    when = samples[-1][0] + timedelta(seconds=SAMPLE_SECS)
+    begin = time.perf_counter()
+    for _ in range(100):
+        forecast = profile.forecast(when, 96, 15)[0]
+    print(f'predict: {round((time.perf_counter() - begin) / 100 * 1000, 2)}ms for 96 slots')
+
+    actual = [sum(load(when + timedelta(minutes=15 * slot, seconds=15 * i)) for i in range(60)) / 60
+              for slot in range(96)]
+    baseline = flat.forecast(when, 96, 15)
+    for (name, values) in [('profile', forecast), ('flat', baseline)]:
+        error = sum(abs(a - v) for (a, v) in zip(actual, values)) / len(actual)
+        print(f'{name} mean absolute error over the next day: {round(error, 3)}kW')
+
+
+if __name__ == '__main__':
+    main()
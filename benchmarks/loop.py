@@ -0,0 +1,172 @@
+"""Drive the whole control loop from replayed samples and time each stage of every tick.
+
+The charger is SimQuasar and Telegram is a stand in that only runs update_info, everything
+else is the real thing. Run from the repository root with:
+    python -m benchmarks.loop [DataLogger folder]
+"""
+import argparse
+from config import Config
+from current import CurrentMonitor, CurrentType, current_combine
+from datalogger import DataLogger
+from datetime import datetime, timedelta
+from handlers import HandlerRegistry
+from hysteresis import OnOff
+import json
+from math import pi, sin
+from nvi import NonVolatileInformation
+from pathlib import Path
+import random
+from recommend import Recommend
+from simulate import DEFAULTS, LOGGER, SimQuasar
+from sources import ReplaySource
+from state import Mode, Modes
+from tele_bot import Info, TelegramBot
+import tempfile
+import time
+import timing
+import tracemalloc
+
+NAMES = ['Solar', 'House', 'Car', 'Heat Pump', 'Grid']
+TYPES = [CurrentType.Source, CurrentType.Drain, CurrentType.Unknown, CurrentType.Drain,
+         CurrentType.Unknown]
+STAGES = ['read', 'combine', 'recommend', 'balance', 'charger', 'log', 'notify']
+# How far the clock moves each tick, as if the Lechacal sent a line this often
+TICK_SECS = 5
+
+
+class StubBot:
+    """Just enough of TelegramBot for update_info, with nothing to send to."""
+
+    update_info = TelegramBot.update_info
+    remove_handler = TelegramBot.remove_handler
+
+    def __init__(self, modes: Modes, quasar: SimQuasar):
+        self.modes = modes
+        self.quasar = quasar
+        self.info = Info()
+        self.change_handlers = HandlerRegistry()
+
+
+def write_samples(folder: Path, rows: int):
+    """A day or so of made up samples in DataLogger's CSV format."""
+    random.seed(0)
+    when = datetime(2022, 6, 1)
+    with open(folder / 'D19144.csv', 'w') as fp:
+        fp.write('Time,' + ','.join([f'{n}({t.name})' for (n, t) in zip(NAMES, TYPES)])
+                 + ',Recommended,Mode,SoC,Metadata')
+        for _ in range(rows):
+            hour = when.hour + when.minute / 60
+            solar = round(max(0, 20 * sin((hour - 6) / 12 * pi)) + random.random(), 4)
+            house = round(3 + random.random() * 4, 4)
+            fp.write(f'\n{when.isoformat()},{solar},{house},0,{round(random.random() * 2, 4)},\
+{round(house - solar, 4)},0,CD,60,')
+            when += timedelta(seconds=15)
+
+
+class Timer:
+    def __init__(self):
+        self._last = time.perf_counter()
+
+    def lap(self) -> float:
+        """Seconds since the last lap."""
+        now = time.perf_counter()
+        (elapsed, self._last) = (now - self._last, now)
+        return elapsed
+
+
+class Allocations:
+    """Measures allocations with tracemalloc, run stops it at the end."""
+
+    def __init__(self):
+        tracemalloc.start()
+        self._last = tracemalloc.get_traced_memory()[0]
+
+    def lap(self) -> int:
+        """The most memory allocated at once since the last lap, in bytes."""
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        (allocated, self._last) = (peak - self._last, current)
+        return allocated
+
+
+def percentile(values: list, fraction: float) -> float:
+    return sorted(values)[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(work: Path, samples: Path, ticks: int, rate: float, traced: bool) -> dict:
+    """Run ticks passes of the loop, returning each stage's times or allocations per tick."""
+    config = Config(work, NAMES, TYPES, **DEFAULTS, logger=LOGGER)
+    with open(work / 'settings.json', 'w') as fp:
+        json.dump({'token': '', 'chats': {}}, fp)
+    nvi = NonVolatileInformation(work / 'settings.json')
+    quasar = SimQuasar()
+    modes = Modes(config, Mode.CHARGE_DISCHARGE, nvi, quasar)
+    recommend = Recommend(config)
+    on_off = OnOff(4)
+    clock = timing.FixedClock(datetime(2022, 6, 1).timestamp())
+    timing.set_clock(clock)
+    data_logger = DataLogger(config, 15, Path('data'))
+    tbot = StubBot(modes, quasar)
+    source = ReplaySource(samples, rate=rate)
+    monitor = CurrentMonitor(len(NAMES), source=source)
+    results = {stage: [] for stage in STAGES}
+    lap = Allocations().lap if traced else Timer().lap
+    try:
+        for _ in range(ticks):
+            clock.advance(TICK_SECS)
+            timing.tick()
+            lap()
+            currents = monitor.read()
+            results['read'].append(lap())
+            estimated = current_combine(currents, TYPES)
+            results['combine'].append(lap())
+            recommend.observe(currents, estimated)
+            recommended = recommend.current(estimated, modes, quasar)
+            results['recommend'].append(lap())
+            charge_rate = on_off.balance(recommended)
+            results['balance'].append(lap())
+            quasar.set_charge_rate(charge_rate)
+            results['charger'].append(lap())
+            data_logger.tick(currents, recommended, Mode.CHARGE_DISCHARGE, quasar.soc)
+            results['log'].append(lap())
+            tbot.update_info(currents, estimated, recommended, charge_rate, quasar.soc)
+            results['notify'].append(lap())
+    finally:
+        source.close()
+        if traced:
+            tracemalloc.stop()
+        data_logger.cleanup()
+        timing.set_clock(None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('folder', type=Path, nargs='?', help='replay this instead of made up data')
+    parser.add_argument('--ticks', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=5000.0,
+                        help='how many times faster than logged to replay')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work:
+        work = Path(work)
+        samples = args.folder
+        if samples is None:
+            samples = work / 'samples'
+            samples.mkdir()
+            write_samples(samples, args.ticks * 2 + 100)
+        times = run(work, samples, args.ticks, args.rate, False)
+        allocations = run(work, samples, args.ticks, args.rate, True)
+    print(f'{args.ticks} ticks, times in us, allocated is the most memory a stage had allocated \
+at once')
+    for stage in STAGES:
+        print(f'{stage}: p50 {round(percentile(times[stage], 0.5) * 1e6, 1)}, \
+p99 {round(percentile(times[stage], 0.99) * 1e6, 1)}, \
+allocated p50 {percentile(allocations[stage], 0.5)}B, \
+mean {round(sum(allocations[stage]) / args.ticks)}B')
+    total = [sum(t) for t in zip(*[times[s] for s in STAGES if s != 'read'])]
+    print(f'without read: p50 {round(percentile(total, 0.5) * 1e6, 1)}, \
+p99 {round(percentile(total, 0.99) * 1e6, 1)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Compare parse_line with the old str based parsing of Lechacal lines.
+
+Run from the repository root with: python -m benchmarks.parse
+"""
+from array import array
+from current import parse_line
+import timeit
+
+LINE = b'11 2401.57 11873.34 0.00 652.88 9544.12 0.00 0.00 0.00 0.00 0.00 0.00\r\n'
+NUM = 5
+
+
+def str_parse(line: bytes, num: int) -> list:
+    line = line[:-2]
+    line = ''.join(map(chr, line))
+    line = line.split(' ')
+    if len(line) > num + 1:
+        return [round(float(p) / 240, 4) for p in line[1:num + 1]]
+    else:
+        raise TypeError(f'Did not expect: {line}')
+
+
+def main(number: int = 200000):
+    out = array('d', bytes(8 * NUM))
+    parse_line(LINE, NUM, out)
+    if out.tolist() != str_parse(LINE, NUM):
+        raise ValueError('parse_line disagrees with the str parser')
+    for (name, func) in [('str', lambda: str_parse(LINE, NUM)),
+                         ('bytes', lambda: parse_line(LINE, NUM, out))]:
+        secs = min(timeit.repeat(func, number=number, repeat=5))
+        print(f'{name}: {round(secs / number * 1e6, 2)}us per line')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Drive Quasar against the emulator under different faults and time each control tick.
+
+Run from the repository root with: python -m benchmarks.quasar
+"""
+from emulator import ChargerModel, Emulator, Faults
+from quasar import Quasar
+import random
+import time
+
+# (name, Faults arguments)
+SCENARIOS = [
+    ('clean', {}),
+    ('2ms latency', {'latency': 0.002, 'jitter': 0.002}),
+    ('2% dropped', {'drop': 0.02}),
+    ('2% errors', {'error': 0.02}),
+    ('all of them', {'latency': 0.002, 'jitter': 0.002, 'drop': 0.02, 'error': 0.02}),
+]
+AMPS = [-16, -10, -6, -3, 0, 3, 6, 10, 16, 32]
+
+
+def percentile(values: list, fraction: float) -> float:
+    return sorted(values)[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(faults: Faults, persistent: bool, ticks: int) -> dict:
+    """Do what the charger stage does each tick, changing the rate every few ticks."""
+    emulator = Emulator('127.0.0.1', 0, ChargerModel(), faults)
+    emulator.start()
+    rng = random.Random(0)
+    try:
+        quasar = Quasar(*emulator.address, persistent=persistent)
+        quasar.take_control()
+        times = []
+        begin = time.perf_counter()
+        for i in range(ticks):
+            start = time.perf_counter()
+            if i % 4 == 0:
+                quasar.set_charge_rate(rng.choice(AMPS))
+            quasar.flush()
+            quasar.soc
+            quasar.charger_status
+            quasar.check_connection()
+            times.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - begin
+        quasar.cleanup()
+    finally:
+        emulator.stop()
+    return {'ticks/s': round(ticks / elapsed), 'p50': round(percentile(times, 0.5) * 1000, 2),
+            'p99': round(percentile(times, 0.99) * 1000, 2),
+            'max': round(max(times) * 1000, 2), 'requests': emulator.requests,
+            'reconnects': quasar.stats.reconnects, 'failures': quasar.stats.failures}
+
+
+def main(ticks: int = 2000):
+    print('times in ms')
+    for (name, args) in SCENARIOS:
+        for persistent in (True, False):
+            result = run(Faults(seed=0, **args), persistent, ticks)
+            kind = 'persistent' if persistent else 'per request'
+            print(f'{name} ({kind}): ' + ', '.join(f'{k} {v}' for (k, v) in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Fixed width binary datalog records, a compact alternative to the CSV files.
+
+Each tick is one little endian record of the epoch seconds (uint32), a float32 per current,
+the recommendation (int8), the mode (uint8, Mode.value) and the SoC (uint8). The records have
+no header so a .bin file can be memory mapped as it is. Its .meta side file starts with the
+matching CSV header followed by 'epoch,metadata' lines.
+"""
+from datetime import datetime
+from pathlib import Path
+from state import Mode, mode_shorthand
+import struct
+
+
+def record_struct(num: int) -> struct.Struct:
+    """The layout of one record with num currents."""
+    return struct.Struct(f'<I{num}fbBB')
+
+
+def meta_path(path: Path) -> Path:
+    return path.with_suffix('.meta')
+
+
+def read_header(path: Path) -> str:
+    with open(meta_path(path), 'r') as fp:
+        return fp.readline().rstrip('\n')
+
+
+def read_metadata(path: Path) -> list:
+    """Get the (epoch, metadata) pairs logged alongside a .bin file."""
+    metadata = []
+    with open(meta_path(path), 'r') as fp:
+        fp.readline()
+        for line in fp:
+            (epoch, text) = line.rstrip('\n').split(',', 1)
+            metadata.append((int(epoch), text))
+    return metadata
+
+
+def read_records(path: Path, num: int):
+    """Yield each record in a .bin file as a tuple."""
+    record = record_struct(num)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    # Ignore a partially written record at the end
+    end = len(data) - len(data) % record.size
+    yield from record.iter_unpack(memoryview(data)[:end])
+
+
+def export_csv(path: Path, num: int):
+    """Yield a .bin file as the text of the CSV DataLogger would have written for it."""
+    metadata = read_metadata(path)
+    yield read_header(path)
+    i = 0
+    records = list(read_records(path, num))
+    for (n, record) in enumerate(records):
+        epoch = record[0]
+        mes = datetime.fromtimestamp(epoch).isoformat()
+        mes += ''.join([f',{round(c, 4)}' for c in record[1:num + 1]])
+        mes += f',{record[num + 1]},{mode_shorthand(Mode(record[num + 2]))},{record[num + 3]}'
+        next_epoch = records[n + 1][0] if n + 1 < len(records) else None
+        while i < len(metadata) and (next_epoch is None or metadata[i][0] < next_epoch):
+            mes += f',{metadata[i][1]}'
+            i += 1
+        yield f'\n{mes}'
+
+
+def load_array(path: Path, num: int):
+    """Memory map a .bin file as a NumPy structured array."""
+    import numpy as np
+    dtype = np.dtype([('time', '<u4'), ('currents', '<f4', (num,)), ('recommended', 'i1'),
+                      ('mode', 'u1'), ('soc', 'u1')])
+    if path.stat().st_size < dtype.itemsize:
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype, mode='r', shape=(path.stat().st_size // dtype.itemsize,))
@@ -0,0 +1,169 @@
+"""PNG charts of the datalog, decimated as it is read so that any range draws in about the
+same time.
+
+matplotlib is only imported when the first chart is drawn.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datalogger import DataLogger
+from datetime import datetime
+import io
+import math
+from query import History
+import threading
+import timing
+
+# The background colour of each mode, by shorthand
+MODE_COLOURS = {'O': '#eeeeee', 'CO': '#e3f2fd', 'CD': '#e8f5e9', 'MC': '#fff3e0', 'A': '#f3e5f5'}
+
+
+class MinMax:
+    """Decimates a series as it is read to the min and max of each time bucket, in time order.
+
+    Unlike averaging this keeps every peak and trough, so the chart looks the same as one of
+    all the samples, and only two samples a bucket are ever kept.
+    """
+
+    def __init__(self, start: float, width: float):
+        self.start = start
+        self.width = width
+        self.times = []
+        self.values = []
+        self._bucket = None
+        self._low = None
+        self._high = None
+
+    def add(self, when: float, value: float):
+        b = int((when - self.start) // self.width)
+        if b != self._bucket:
+            self._emit()
+            self._bucket = b
+            self._low = self._high = (when, value)
+        elif value < self._low[1]:
+            self._low = (when, value)
+        elif value > self._high[1]:
+            self._high = (when, value)
+
+    def _emit(self):
+        if self._bucket is None:
+            return
+        for (when, value) in sorted({self._low, self._high}):
+            self.times.append(when)
+            self.values.append(value)
+
+    def finish(self) -> tuple:
+        """Get (times, values) of everything added."""
+        self._emit()
+        self._bucket = None
+        return (local_times(self.times), self.values)
+
+
+def local_times(times: list) -> list:
+    return [datetime.fromtimestamp(t) for t in times]
+
+
+class Charter:
+    """Draws charts on a worker thread, keeping the last cache_size of them.
+
+    A chart is drawn again only if a log file it covers has changed since it was last drawn,
+    and then not until refresh_secs after, so one of the day being logged is redrawn at most
+    that often. The end of a chart is rounded up to the minute, so asking again for one up to
+    now finds it.
+    """
+
+    def __init__(self, datalogger: DataLogger, history: History, buckets: int = 500,
+                 cache_size: int = 16, refresh_secs: float = 60):
+        self.datalogger = datalogger
+        self.history = history
+        self.buckets = buckets
+        self.cache_size = cache_size
+        self.refresh_secs = refresh_secs
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1, 'chart')
+
+    def chart(self, start: float, end: float, channels: list = None) -> Future:
+        """A Future of a PNG (as bytes) of [start, end), or None if there's nothing in it.
+
+        channels are the names of the currents to draw, all of them if None. Recommended,
+        the mode and the SoC are always drawn on top.
+        """
+        if channels is not None:
+            for name in channels:
+                if name not in self.datalogger.names:
+                    raise ValueError(f'Did not expect channel \'{name}\'')
+        end = math.ceil(end / 60) * 60
+        return self._executor.submit(self._chart, start, end, channels)
+
+    def _chart(self, start: float, end: float, channels: list):
+        self.datalogger.flush()
+        key = (start, end, None if channels is None else tuple(channels))
+        signature = self.history.signature(start, end)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and (cached[0] == signature or
+                                       timing.monotonic() - cached[1] < self.refresh_secs):
+                self._cache.move_to_end(key)
+                return cached[2]
+        png = self._draw(start, end, channels)
+        with self._lock:
+            self._cache[key] = (signature, timing.monotonic(), png)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return png
+
+    def _draw(self, start: float, end: float, channels: list):
+        columns = self.history.columns()
+        if columns == []:
+            return None
+        names = self.datalogger.names if channels is None else channels
+        drawn = [columns.index(name) for name in names if name in columns]
+        indices = drawn + [columns.index('Recommended'), columns.index('SoC')]
+        width = max((end - start) / self.buckets, 1.0)
+        series = [MinMax(start, width) for _ in indices]
+        changes = []
+        last = None
+        for (when, values, mode) in self.history.rows_with_mode(start, end):
+            for (s, i) in zip(series, indices):
+                s.add(when, values[i])
+            if changes == [] or changes[-1][1] != mode:
+                changes.append((when, mode))
+            last = when
+        if last is None:
+            return None
+
+        # A Figure on its own draws with Agg and needs nothing from pyplot
+        from matplotlib.figure import Figure
+        figure = Figure(figsize=(10, 5), dpi=100)
+        axes = figure.add_subplot()
+        ends = [when for (when, _) in changes[1:]] + [last]
+        for ((when, mode), to) in zip(changes, ends):
+            (left, right) = local_times([when, to])
+            axes.axvspan(left, right, color=MODE_COLOURS.get(mode, '#ffffff'), lw=0)
+            axes.text(left, 0.01, mode, transform=axes.get_xaxis_transform(), fontsize=8,
+                      color='grey')
+        for (s, i) in zip(series, drawn):
+            axes.plot(*s.finish(), lw=0.8, label=columns[i])
+        axes.step(*series[-2].finish(), where='post', color='black', ls='--', lw=0.8,
+                  label='Recommended')
+        axes.set_ylabel('Current (A)')
+        axes.grid(alpha=0.3)
+        soc_axes = axes.twinx()
+        soc_axes.plot(*series[-1].finish(), color='tab:red', lw=1, alpha=0.6, label='SoC')
+        soc_axes.set_ylabel('SoC (%)')
+        soc_axes.set_ylim(0, 100)
+        lines = axes.get_legend_handles_labels()
+        soc_lines = soc_axes.get_legend_handles_labels()
+        axes.legend(lines[0] + soc_lines[0], lines[1] + soc_lines[1], loc='upper left',
+                    fontsize=8, ncol=4)
+        axes.set_title(f'{datetime.fromtimestamp(start):%Y-%m-%d %H:%M} to \
+{datetime.fromtimestamp(end):%Y-%m-%d %H:%M}')
+        figure.autofmt_xdate()
+        figure.tight_layout()
+        png = io.BytesIO()
+        figure.savefig(png, format='png')
+        return png.getvalue()
+
+    def cleanup(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
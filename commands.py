@@ -1,12 +1,17 @@
+from datetime import datetime
 from pathlib import Path
 from config import Config
 from datalogger import DataLogger
+from chart import Charter
+from export import Exporter
 from handlers import LiveStatusHandler, RecommendHandler
+from query import History, parse_range
 from state import Mode, Modes
 from tele_bot import TelegramBot
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CallbackContext
 from quasar import Quasar
+import timing
 
 def password(f):
     """Check if this chat has entered the correct password."""
@@ -23,6 +28,11 @@ class TeleCommands:
         tbot = TelegramBot(config, datalogger, Mode.OFF, quasar)
         self.tbot = tbot
         self.recommending = {}
+        self.metrics = None
+        self.history = History(datalogger.folder)
+        # Its own History, since the exporter reads it on its worker thread
+        self.exporter = Exporter(datalogger, History(datalogger.folder))
+        self.charter = Charter(datalogger, History(datalogger.folder))
         tbot.add_command('start', self.start)
         tbot.add_command('status', self.status)
         tbot.add_command('latestfile', self.latestfile)
@@ -30,10 +40,15 @@ class TeleCommands:
         tbot.add_command('log', self.log)
         tbot.add_command('listfiles', self.listfiles)
         tbot.add_command('file', self.file)
+        tbot.add_command('range', self.range)
+        tbot.add_command('chart', self.chart)
+        tbot.add_command('summary', self.summary)
         tbot.add_command('statuskw', self.statuskw)
         tbot.add_command('recommend', self.recommend)
         tbot.add_command('charger_status', self.charger_status)
         tbot.add_command('soc', self.soc)
+        tbot.add_command('modbus', self.modbus)
+        tbot.add_command('latency', self.latency)
         tbot.add_command('test', self.test)
         tbot.add_command('off', self.off)
         tbot.add_command('auto', self.auto)
@@ -67,9 +82,25 @@ class TeleCommands:
     def status(self, update: Update, _: CallbackContext):
         self.tbot.reply_text(update, self.tbot.formatted_current())
 
+    def _send_when_ready(self, update: Update, future, reply):
+        """Reply with what a future gives once it is ready, without waiting for it."""
+        def done(f):
+            try:
+                result = f.result()
+            except:  # noqa
+                self.tbot.logger.exception('Preparing:')
+                result = None
+            if result is None:
+                self.tbot.send_text('Nothing to send', self.tbot.get_chat_id(update))
+            else:
+                reply(update, result)
+        self.tbot.send_text('Preparing...', self.tbot.get_chat_id(update), silent=True)
+        future.add_done_callback(done)
+
     @password
     def latestfile(self, update: Update, _: CallbackContext):
-        self.tbot.reply_document(update, self.datalogger.fp)
+        self._send_when_ready(update, self.exporter.file(self.datalogger.fp),
+                              self.tbot.reply_document)
 
     @password
     def live(self, update: Update, _: CallbackContext):
@@ -94,20 +125,109 @@ class TeleCommands:
 
     @password
     def listfiles(self, update: Update, _: CallbackContext):
-        files = [f.stem for f in self.datalogger.folder.iterdir()]
+        files = list({f.stem for f in self.datalogger.folder.iterdir() if f.is_file()})
         files.sort()
         self.tbot.reply_text(update, ', '.join(files))
 
     @password
     def file(self, update: Update, _: CallbackContext):
+        args = update.message.text.split(' ')[1:]
+        try:
+            if len(args) > 2:
+                bucket_secs = int(args[2]) * 60
+                args = args[:2]
+            else:
+                bucket_secs = None
+            (start, end) = parse_range(args)
+        except (IndexError, ValueError):
+            pass
+        else:
+            self._send_when_ready(update, self.exporter.range(start, end, bucket_secs),
+                                  self.tbot.reply_document)
+            return
         file = self.tbot.second_item(update,
                                      error='Incorrectly formatted command, please specify a file')
         if file != '':
             file = self.datalogger.folder / Path(f'{file}.csv')
             if not file.exists():
-                self.tbot.reply_text(update, f'File: {file} does not exist')
+                file = file.with_suffix('.bin')
+            if not file.exists():
+                self.tbot.reply_text(update, f'File: {file.with_suffix(".csv")} does not exist')
+            else:
+                self._send_when_ready(update, self.exporter.file(file), self.tbot.reply_document)
+
+    @password
+    def range(self, update: Update, _: CallbackContext):
+        args = update.message.text.split(' ')[1:]
+        try:
+            if len(args) > 2:
+                bucket_secs = int(args[2]) * 60
+                args = args[:2]
+            else:
+                bucket_secs = None
+            (start, end) = parse_range(args)
+        except (IndexError, ValueError):
+            self.tbot.reply_text(update, 'Please specify a range like /range 17:00 19:00 [bucket minutes] or /range 2022-05-01')
+            return
+        self.datalogger.flush()
+        columns = self.history.columns()
+        if bucket_secs is None:
+            summary = self.history.summary(start, end)
+            if summary is None:
+                self.tbot.reply_text(update, 'No data in that range')
+                return
+            hours = summary.count * self.datalogger.freq / 3600
+            message = [f'{summary.count} readings']
+            for (name, low, mean, high) in zip(columns, summary.mins, summary.means, summary.maxs):
+                message.append(f'{name}: {round(low, 1)}/{round(mean, 1)}/{round(high, 1)} (min/mean/max)')
+            for (name, mean) in zip(columns[:len(self.config.names)], summary.means):
+                message.append(f'{name}: ~{round(mean * 0.24 * hours, 2)}kWh')
+        else:
+            buckets = self.history.downsample(start, end, bucket_secs)[:48]
+            if buckets == []:
+                self.tbot.reply_text(update, 'No data in that range')
+                return
+            message = ['Time ' + ' '.join(columns)]
+            for bucket in buckets:
+                when = datetime.fromtimestamp(bucket.start)
+                message.append(f'{when:%H:%M} ' + ' '.join([str(round(m, 1)) for m in bucket.means]))
+        self.tbot.reply_text(update, '\n'.join(message))
+
+    @password
+    def chart(self, update: Update, _: CallbackContext):
+        args = update.message.text.split(' ')[1:]
+        channels = None
+        if args != [] and args[-1][:1].isalpha():
+            channels = [c.replace('_', ' ') for c in args.pop().split(',')]
+        try:
+            (start, end) = parse_range(args if args != [] else ['00:00'])
+            future = self.charter.chart(start, end, channels)
+        except (IndexError, ValueError):
+            self.tbot.reply_text(update, f'Please specify a range and channels like /chart 17:00 19:00 Solar,House or /chart 2022-05-01, the channels are {",".join(self.config.names)}')
+            return
+        self._send_when_ready(update, future, self.tbot.reply_photo)
+
+    @password
+    def summary(self, update: Update, _: CallbackContext):
+        arg = self.tbot.second_item(update, default='1')
+        rollup = self.datalogger.rollup
+        try:
+            if '-' in arg:
+                day = datetime.fromisoformat(arg)
+                title = f'{day:%Y-%m-%d}'
+                totals = rollup.days(day, 1)
             else:
-                self.tbot.reply_document(update, file)
+                days = int(arg)
+                title = 'Today' if days == 1 else f'The last {days} days'
+                totals = rollup.days(timing.now(), days)
+        except ValueError:
+            self.tbot.reply_text(update, 'Please specify a number of days or a date like 2022-05-01')
+            return
+        message = f'{title}:\n{rollup.summary_text(totals)}'
+        if arg == '1':
+            hour = rollup.totals('hours', [f'{timing.now():%Y-%m-%dT%H}'])
+            message += f'\nThis hour:\n{rollup.summary_text(hour)}'
+        self.tbot.reply_text(update, message)
 
     @password
     def statuskw(self, update: Update, _: CallbackContext):
@@ -136,6 +256,8 @@ class TeleCommands:
             if recommending is not None:
                 self.tbot.reply_text(update, f'Extending recommendations for {mins_for} minutes')
                 recommending.update_timer(secs_for)
+                # It may have finished and been removed already
+                self.tbot.add_handler(recommending)
             else:
                 self.tbot.reply_text(update, f'Toggling recommendations on for {mins_for} minutes')
                 handler = RecommendHandler(self.tbot, chat_id, secs_for)
@@ -154,6 +276,17 @@ class TeleCommands:
         else:
             self.tbot.reply_text(update, f'{soc}%')
 
+    @password
+    def modbus(self, update: Update, _: CallbackContext):
+        self.tbot.reply_text(update, str(self.quasar.stats))
+
+    @password
+    def latency(self, update: Update, _: CallbackContext):
+        if self.metrics is None:
+            self.tbot.reply_text(update, 'N/A')
+        else:
+            self.tbot.reply_text(update, str(self.metrics))
+
     @password
     def test(self, update: Update, _: CallbackContext):
         self.tbot.reply_text(update, f'RPi thinks {self.quasar._charging}, Quasar thinks {self.quasar.read_register(0x101)}.')
@@ -334,12 +467,18 @@ class TeleCommands:
     def more(self, update: Update, _: CallbackContext):
         self.tbot.reply_text(update, '''/log - Add something to the datalog
 /statuskw - Status in kW
-/latestfile - Download latest datalog file
+/latestfile - Download latest datalog file, compressed
 /listfiles - List all datalog files
-/file <filename> - Download a given datalog file
+/file <filename> - Download a given datalog file, compressed
+/file <start> [end] [bucket] - Download the datalog between two times, in bucket minute means
+/range <start> [end] [bucket] - Summarise the datalog between two times
+/chart [start] [end] [channels] - Chart the datalog between two times, today by default
+/summary [days or date] - Energy and cost totals
 /recommend - Ping with any recommendation changes
 /charger_status - Get the current charger status
 /soc - Get the state of charge of the car
+/modbus - Get the charger connection statistics
+/latency - Get the latency of each stage of the control loop
 /test - (temp) Testing the morning behaviour
 /min_discharge_rate - Set the minimum discharge rate
 /pump_threshold - Change the heat pump subtraction threshold
@@ -353,4 +492,6 @@ class TeleCommands:
         raise KeyboardInterrupt
 
     def cleanup(self):
+        self.exporter.cleanup()
+        self.charter.cleanup()
         self.tbot.cleanup()
@@ -2,6 +2,7 @@
 from datetime import datetime
 import logging
 from pathlib import Path
+from tariff import Tariff
 
 
 class Config:
@@ -10,8 +11,13 @@ class Config:
     def __init__(self, path: Path, names: list, current_types: list, day_rate: float,
                  night_rate: float, efficiency: float, night_start: tuple, night_end: tuple,
                  min_charge: int, summer_max_charge: int, winter_max_charge: int,
-                 secondary_night_start = None):
-        """Create all the variables."""
+                 secondary_night_start = None, tariff: Tariff = None,
+                 logger: logging.Logger = None):
+        """Create all the variables.
+
+        Without a tariff the prices come from the day and night rates and times. Without a
+        logger the root logger is set up to log to a new file in the logs folder.
+        """
         self.path = path
         self.names = names
         self.current_types = current_types
@@ -22,20 +28,36 @@ class Config:
         self.summer_max_charge = summer_max_charge
         self.winter_max_charge = winter_max_charge
         self.secondary_night_start = secondary_night_start
+        self._custom_tariff = tariff
+        self.tariff = tariff
+        self.day_rate = day_rate
+        self.night_rate = night_rate
         self.update_day_rate(day_rate)
         self.update_night_rate(night_rate)
-        self.setup_logging()
+        if logger is None:
+            self.setup_logging()
+        else:
+            self.logger = logger
 
     def update_night_rate(self, night_rate: float):
         self.night_rate = night_rate
         self.discharge_rate = round(night_rate / self.efficiency, 1)
         self.low_night = round(night_rate - 0.1, 1)
         self.high_night = round(night_rate + 0.1, 1)
+        self._update_tariff()
 
     def update_day_rate(self, day_rate: float):
         self.day_rate = day_rate
         self.low_day = round(day_rate - 0.1, 1)
         self.high_day = round(day_rate + 0.1, 1)
+        self._update_tariff()
+
+    def _update_tariff(self):
+        if self._custom_tariff is None:
+            bands = [(self.night_start, self.night_end, self.night_rate)]
+            if self.secondary_night_start is not None:
+                bands.append((self.secondary_night_start, (24, 0), self.night_rate))
+            self.tariff = Tariff(self.day_rate, bands)
 
     def setup_logging(self):
         """Set up all the logging stuff."""
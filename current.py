@@ -1,6 +1,9 @@
 """Handles everything to do with current monitoring."""
+from array import array
 from enum import Enum
 from serial import Serial
+import threading
+import timing
 
 
 class CurrentType(Enum):
@@ -11,25 +14,121 @@ class CurrentType(Enum):
     Unknown = 0,
 
 
+def parse_line(line: bytes, num: int, out: array, offset: int = 0):
+    """Write the currents from one Lechacal line into out[offset:offset + num].
+
+    The fields are split straight out of the bytes and converted by float, without decoding
+    the line to a str first.
+    """
+    fields = line.split(b' ', num + 1)
+    if len(fields) <= num + 1:
+        raise TypeError(f'Did not expect: {line}')
+    for i in range(num):
+        out[offset + i] = round(float(fields[i + 1]) / 240, 4)
+
+
+class SampleBuffer:
+    """A fixed size ring of timestamped samples, the oldest is dropped once it is full.
+
+    The samples live in preallocated arrays that are reused as the ring wraps around.
+    """
+
+    def __init__(self, size: int, num: int):
+        """Allocate the ring."""
+        self.size = size
+        self.num = num
+        self._values = array('d', bytes(8 * size * num))
+        self._times = array('d', bytes(8 * size))
+        self._scratch = array('d', bytes(8 * num))
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._consumed = 0
+        self.dropped = 0
+        self.malformed = 0
+
+    def _sample(self, seq: int) -> tuple:
+        slot = (seq - 1) % self.size
+        return (self._times[slot], self._values[slot * self.num:(slot + 1) * self.num].tolist())
+
+    def _commit(self, timestamp: float, values: array):
+        with self._cond:
+            if self._seq - self.size >= self._consumed:
+                self.dropped += 1
+            slot = self._seq % self.size
+            self._values[slot * self.num:(slot + 1) * self.num] = values
+            self._times[slot] = timestamp
+            self._seq += 1
+            self._cond.notify_all()
+
+    def append(self, timestamp: float, currents: list):
+        """Add a sample, counting the oldest as dropped if it is pushed out unread."""
+        self._commit(timestamp, array('d', currents))
+
+    def append_line(self, timestamp: float, line: bytes):
+        """Parse a line from the HAT and add it, counting it if it is malformed."""
+        try:
+            parse_line(line, self.num, self._scratch)
+        except (TypeError, ValueError):
+            self.malformed += 1
+            return
+        self._commit(timestamp, self._scratch)
+
+    def latest(self):
+        """Get the newest (timestamp, currents), or None if there isn't one yet."""
+        with self._cond:
+            if self._seq == 0:
+                return None
+            self._consumed = self._seq
+            return self._sample(self._seq)
+
+    def window(self, n: int) -> list:
+        """Get up to the n newest (timestamp, currents), oldest first."""
+        with self._cond:
+            first = max(self._seq - min(n, self.size), 0) + 1
+            return [self._sample(seq) for seq in range(first, self._seq + 1)]
+
+    def wait_newer(self, timeout: float):
+        """Wait for a sample newer than the last one consumed and return the newest."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > self._consumed, timeout):
+                return None
+            return self.latest()
+
+
 class CurrentMonitor:
     """Monitors the current readings from the Lechacal HAT."""
 
     def __init__(self, num: int, port: str = '/dev/ttyAMA0', baudrate: int = 38400,
-                 timeout: int = 10):
-        """Open the serial connection."""
+                 timeout: int = 10, size: int = 64, source=None):
+        """Open the serial connection and start reading it in the background.
+
+        A source (see sources.py) is read instead of the serial port if one is given.
+        """
         self.num = num
-        self.ser = Serial(port, baudrate, timeout=timeout)
+        self.timeout = timeout
+        self.ser = Serial(port, baudrate, timeout=timeout) if source is None else source
+        self.buffer = SampleBuffer(size, num)
+        self._error = None
+        self._thread = threading.Thread(target=self._ingest, name='serial', daemon=True)
+        self._thread.start()
+
+    def _ingest(self):
+        try:
+            while True:
+                line = self.ser.readline()
+                if line != b'':
+                    self.buffer.append_line(timing.time(), line)
+        except Exception as e:
+            self._error = e
 
     def read(self) -> list:
-        """Read one line in from the serial port and reduce it to currents."""
-        line = self.ser.readline()
-        line = line[:-2]
-        line = ''.join(map(chr, line))
-        line = line.split(' ')
-        if len(line) > self.num + 1:
-            return [round(float(p) / 240, 4) for p in line[1:self.num + 1]]
-        else:
-            raise TypeError(f'Did not expect: {line}')
+        """Wait for a newer sample than the last one read and return its currents."""
+        sample = self.buffer.wait_newer(self.timeout)
+        if self._error is not None:
+            raise self._error
+        if sample is None:
+            raise TypeError(f'No reading in {self.timeout} seconds')
+        return sample[1]
 
 
 def current_combine(currents: list, current_types: list) -> float:
@@ -1,16 +1,70 @@
 """Handles datalogging."""
+import binlog
 from config import Config
-from datetime import datetime
+from current import current_combine
+import os
 from pathlib import Path
+from rollup import EnergyRollup
 from state import Mode, mode_shorthand
+import threading
 import timing
 
 
+class BufferedLog:
+    """Keeps a file open for appending and writes to it in batches.
+
+    Only whole records are ever buffered so a crash loses at most the unflushed records, the
+    fsync policy is one of 'never', 'flush' (after every batch) or 'always' (after every record).
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 4096, max_secs: int = 60,
+                 fsync: str = 'flush', binary: bool = False):
+        """Open the file."""
+        if fsync not in ('never', 'flush', 'always'):
+            raise ValueError(f'Did not expect fsync policy \'{fsync}\'')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_secs = max_secs
+        self.fsync = fsync
+        self._fp = open(path, 'ab' if binary else 'a')
+        self._empty = b'' if binary else ''
+        self._buffer = []
+        self._size = 0
+        self._last_flush = timing.monotonic()
+
+    def write(self, text):
+        """Buffer some text (or bytes), flushing if either threshold has been passed."""
+        self._buffer.append(text)
+        self._size += len(text)
+        if (self.fsync == 'always' or self._size >= self.max_bytes
+                or timing.monotonic() - self._last_flush >= self.max_secs):
+            self.flush()
+
+    def flush(self):
+        """Write out everything buffered."""
+        if self._buffer != []:
+            self._fp.write(self._empty.join(self._buffer))
+            self._fp.flush()
+            if self.fsync != 'never':
+                os.fsync(self._fp.fileno())
+            self._buffer = []
+            self._size = 0
+        self._last_flush = timing.monotonic()
+
+    def close(self):
+        self.flush()
+        self._fp.close()
+
+
 class DataLogger:
     """Logs the data."""
 
-    def __init__(self, config: Config, freq: int, folder: Path):
-        """Create the file to log in and fills in the titles."""
+    def __init__(self, config: Config, freq: int, folder: Path, flush_bytes: int = 4096,
+                 flush_secs: int = 60, fsync: str = 'flush', binary: bool = False):
+        """Create the file to log in and fills in the titles.
+
+        With binary the ticks are logged as binlog records rather than CSV.
+        """
         self.config = config
         self.logger = config.logger
         folder = config.path / folder
@@ -21,54 +75,100 @@ class DataLogger:
         self.names = config.names
         self.current_types = config.current_types
         self.start_time = timing.second_number()
+        self.flush_bytes = flush_bytes
+        self.flush_secs = flush_secs
+        self.fsync = fsync
+        self.binary = binary
+        self._record = binlog.record_struct(len(self.names))
+        self._lock = threading.Lock()
+        self._log = None
+        self._meta = None
+        self._last_epoch = None
+        self.rollup = EnergyRollup(config, config.path / Path('rollup.json'))
         self._new_file()
         self.last_tick = None
 
     def _new_file(self):
+        if self._log is not None:
+            self._log.close()
+        if self._meta is not None:
+            self._meta.close()
         header = 'Time,' + \
             ','.join([f'{n}({t.name})' for (n, t) in zip(self.names, self.current_types)]) + \
             ',Recommended,Mode,SoC,Metadata'
         self.day = timing.comparison_day_number()
         root_filename = f'D{timing.day_number()}'
+        extension = 'bin' if self.binary else 'csv'
         i = 1
         while True:
             if i == 1:
-                test_filename = f'{root_filename}.csv'
+                test_filename = f'{root_filename}.{extension}'
             else:
-                test_filename = f'{root_filename}_{i}.csv'
+                test_filename = f'{root_filename}_{i}.{extension}'
             path = self.folder / test_filename
+            header_path = binlog.meta_path(path) if self.binary else path
             file_header = None
-            if path.is_file():
-                with open(path, 'r') as fp:
+            if header_path.is_file():
+                with open(header_path, 'r') as fp:
                     file_header = fp.readline().replace('\n', '')
                 if file_header == header:
                     self.fp = path
                     break
-            if not path.is_file():
+            if not header_path.is_file():
                 self.fp = path
-                with open(path, 'x') as fp:
+                with open(header_path, 'x') as fp:
                     fp.write(header)
                 break
             i += 1
+        self._log = BufferedLog(self.fp, self.flush_bytes, self.flush_secs, self.fsync,
+                                self.binary)
+        if self.binary:
+            self._meta = BufferedLog(binlog.meta_path(self.fp), self.flush_bytes,
+                                     self.flush_secs, self.fsync)
 
     def tick(self, currents: list, recommended: int, mode: Mode, soc: int):
-        """Log the data if enough time has passed."""
+        """Add to the energy totals, and log the data if enough time has passed."""
+        self.rollup.add(currents, current_combine(currents, self.current_types), timing.now())
         this_tick = timing.second_number() // self.freq
         if self.last_tick is None or self.last_tick < this_tick:
             self.last_tick = this_tick
-            if (timing.comparison_day_number() != self.day
-                    and timing.past_this_time(self.config.night_start)):
-                self._new_file()
-            self._log_to_file(currents, recommended, mode, soc)
+            with self._lock:
+                if (timing.comparison_day_number() != self.day
+                        and timing.past_this_time(self.config.night_start)):
+                    self._new_file()
+                self._log_to_file(currents, recommended, mode, soc)
 
     def _log_to_file(self, currents: list, recommended: int, mode: Mode, soc: int):
-        with open(self.fp, 'a') as fp:
-            mes = str(datetime.now().replace(microsecond=0).isoformat())
-            mes += ''.join([f',{c}' for c in currents])
-            mes += f',{recommended},{mode_shorthand(mode)},{soc}'
-            fp.write(f'\n{mes}')
+        if self.binary:
+            self._last_epoch = timing.second_number()
+            self._log.write(self._record.pack(self._last_epoch, *currents, recommended,
+                                              mode.value, soc))
+            return
+        mes = str(timing.now().replace(microsecond=0).isoformat())
+        mes += ''.join([f',{c}' for c in currents])
+        mes += f',{recommended},{mode_shorthand(mode)},{soc}'
+        self._log.write(f'\n{mes}')
 
     def add_metadata(self, metadata: str):
         """Add a bit of metadata to the datalog."""
-        with open(self.fp, 'a') as fp:
-            fp.write(f',{metadata}')
+        with self._lock:
+            if self.binary:
+                epoch = timing.second_number() if self._last_epoch is None else self._last_epoch
+                metadata = metadata.replace('\n', ' ')
+                self._meta.write(f'\n{epoch},{metadata}')
+            else:
+                self._log.write(f',{metadata}')
+
+    def flush(self):
+        """Make sure everything logged so far is in the file."""
+        with self._lock:
+            self._log.flush()
+            if self._meta is not None:
+                self._meta.flush()
+
+    def cleanup(self):
+        self.rollup.save()
+        with self._lock:
+            self._log.close()
+            if self._meta is not None:
+                self._meta.close()
@@ -0,0 +1,249 @@
+"""A Modbus TCP server that behaves like the Quasar's registers, for testing without a car.
+
+Run from the repository root, e.g.
+    python -m emulator --port 5020 --latency 0.005 --drop 0.01 --error 0.01
+"""
+import argparse
+from quasar import QuasarStatus
+import random
+import socketserver
+import struct
+import threading
+import time
+import timing
+
+# kW per amp, the same conversion /statuskw uses
+KW_PER_AMP = 0.24
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_VALUE = 3
+SLAVE_DEVICE_FAILURE = 4
+
+
+class ChargerModel:
+    """The registers Quasar uses, with a car that charges and discharges at the setpoint.
+
+    Writes to 0x101 (1 start, 2 stop) and 0x102 (signed setpoint) are refused unless 0x51
+    has handed control over. While idle the SoC drifts down by drift percent an hour.
+    """
+
+    def __init__(self, capacity: float = 40.0, soc: float = 60.0, efficiency: float = 0.8,
+                 max_current: int = 32, drift: float = 0.0, connected: bool = True):
+        self.capacity = capacity
+        self.level = soc
+        self.efficiency = efficiency
+        self.drift = drift
+        self.connected = connected
+        self.registers = {0x51: 0, 0x101: 2, 0x102: 0, 0x200: max_current,
+                          0x202: round(max_current * KW_PER_AMP * 1000)}
+        self.status = QuasarStatus.READY if connected else QuasarStatus.DISCONNECTED
+        self._lock = threading.Lock()
+        self._last = timing.monotonic()
+
+    @property
+    def setpoint(self) -> int:
+        value = self.registers[0x102]
+        return value - 65536 if value >= 32768 else value
+
+    def _advance(self):
+        now = timing.monotonic()
+        hours = (now - self._last) / 3600
+        self._last = now
+        if self.status == QuasarStatus.CHARGING:
+            kwh = self.setpoint * KW_PER_AMP * hours * self.efficiency
+        elif self.status == QuasarStatus.DISCHARGING:
+            kwh = self.setpoint * KW_PER_AMP * hours
+        else:
+            kwh = -self.drift / 100 * self.capacity * hours
+        self.level = min(max(self.level + kwh / self.capacity * 100, 0.0), 100.0)
+        if self.status == QuasarStatus.CHARGING and self.level >= 100:
+            self.status = QuasarStatus.WAITING_FOR_CAR_DEMAND
+        elif self.status == QuasarStatus.DISCHARGING and self.level <= 0:
+            self.status = QuasarStatus.PAUSED_BY_USER
+
+    def _update_status(self):
+        if not self.connected:
+            self.status = QuasarStatus.DISCONNECTED
+        elif self.registers[0x101] == 2:
+            self.status = QuasarStatus.PAUSED_BY_USER
+        elif self.setpoint > 0:
+            self.status = (QuasarStatus.CHARGING if self.level < 100
+                           else QuasarStatus.WAITING_FOR_CAR_DEMAND)
+        elif self.setpoint < 0 and self.level > 0:
+            self.status = QuasarStatus.DISCHARGING
+        else:
+            self.status = QuasarStatus.PAUSED_BY_USER
+
+    def read(self, address: int, count: int) -> list:
+        with self._lock:
+            self._advance()
+            values = []
+            for a in range(address, address + count):
+                if a == 0x219:
+                    values.append(self.status.value)
+                elif a == 0x21A:
+                    values.append(round(self.level) if self.connected else 0)
+                else:
+                    values.append(self.registers.get(a, 0))
+            return values
+
+    def write(self, address: int, values: list) -> bool:
+        """Store some registers, returning False (and storing none) if any are refused."""
+        with self._lock:
+            self._advance()
+            addresses = range(address, address + len(values))
+            if self.registers[0x51] != 1 and any(a in (0x101, 0x102) for a in addresses):
+                if 0x51 not in addresses or values[0x51 - address] != 1:
+                    return False
+            for (a, value) in zip(addresses, values):
+                self.registers[a] = value
+            if self.registers[0x51] != 1:
+                self.registers[0x101] = 2
+            self._update_status()
+            return True
+
+    def plug(self, connected: bool):
+        with self._lock:
+            self._advance()
+            self.connected = connected
+            self._update_status()
+
+
+class Faults:
+    """Latency (plus up to jitter more) before each reply, and the chance of a request having
+    its connection dropped or getting a device failure response."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, drop: float = 0.0,
+                 error: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.error = error
+        self._random = random.Random(seed)
+
+    def delay(self) -> float:
+        return self.latency + self._random.random() * self.jitter
+
+    def roll(self) -> str:
+        """Pick what happens to a request: 'drop', 'error' or 'ok'."""
+        x = self._random.random()
+        if x < self.drop:
+            return 'drop'
+        if x < self.drop + self.error:
+            return 'error'
+        return 'ok'
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def _recv(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if chunk == b'':
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        model = self.server.model
+        faults = self.server.faults
+        while True:
+            header = self._recv(7)
+            if header is None:
+                return
+            (transaction, protocol, length, unit) = struct.unpack('>HHHB', header)
+            body = self._recv(length - 1)
+            if body is None:
+                return
+            self.server.requests += 1
+            outcome = faults.roll()
+            delay = faults.delay()
+            if delay > 0:
+                time.sleep(delay)
+            if outcome == 'drop':
+                self.server.dropped += 1
+                return
+            function = body[0]
+            if outcome == 'error':
+                self.server.errors += 1
+                pdu = struct.pack('>BB', function | 0x80, SLAVE_DEVICE_FAILURE)
+            else:
+                pdu = self._respond(model, function, body[1:])
+            self.request.sendall(struct.pack('>HHHB', transaction, protocol, len(pdu) + 1, unit)
+                                 + pdu)
+
+    def _respond(self, model: ChargerModel, function: int, data: bytes) -> bytes:
+        if function == 3:
+            (address, count) = struct.unpack('>HH', data[:4])
+            values = model.read(address, count)
+            return struct.pack(f'>BB{count}H', function, 2 * count, *values)
+        elif function == 6:
+            (address, value) = struct.unpack('>HH', data[:4])
+            if model.write(address, [value]):
+                return struct.pack('>BHH', function, address, value)
+        elif function == 16:
+            (address, count, _) = struct.unpack('>HHB', data[:5])
+            values = list(struct.unpack(f'>{count}H', data[5:5 + 2 * count]))
+            if model.write(address, values):
+                return struct.pack('>BHH', function, address, count)
+        else:
+            return struct.pack('>BB', function | 0x80, ILLEGAL_FUNCTION)
+        return struct.pack('>BB', function | 0x80, ILLEGAL_DATA_VALUE)
+
+
+class Emulator(socketserver.ThreadingTCPServer):
+    """Serves a ChargerModel over Modbus TCP, each connection in its own thread."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5020, model: ChargerModel = None,
+                 faults: Faults = None):
+        super().__init__((host, port), _Handler)
+        self.model = ChargerModel() if model is None else model
+        self.faults = Faults() if faults is None else faults
+        self.requests = 0
+        self.dropped = 0
+        self.errors = 0
+        self._thread = None
+
+    @property
+    def address(self) -> tuple:
+        return self.server_address[:2]
+
+    def start(self):
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name='emulator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5020)
+    parser.add_argument('--soc', type=float, default=60.0)
+    parser.add_argument('--capacity', type=float, default=40.0)
+    parser.add_argument('--drift', type=float, default=0.0, help='SoC lost an hour while idle')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--drop', type=float, default=0.0, help='chance of dropping a request')
+    parser.add_argument('--error', type=float, default=0.0, help='chance of an error response')
+    args = parser.parse_args()
+    emulator = Emulator(args.host, args.port,
+                        ChargerModel(args.capacity, args.soc, drift=args.drift),
+                        Faults(args.latency, args.jitter, args.drop, args.error))
+    print(f'Serving on {args.host}:{args.port}')
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Compressed copies of the datalog for downloading, made on a background worker.
+
+Copies are cached in the export folder and only made again once their source has changed.
+Telegram needs the whole file to upload it, so a copy is always complete on disk before it is
+sent, but the day being logged is only ever compressed once: what has been added to it since
+is appended to the copy as another gzip member (or zstd frame), which decompresses as if it
+were all one.
+"""
+import binlog
+from concurrent.futures import Future, ThreadPoolExecutor
+from datalogger import DataLogger
+from datetime import datetime
+import gzip
+from itertools import chain
+import math
+import os
+from pathlib import Path
+from query import History
+import shutil
+import threading
+import timing
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def open_compressed(path: Path, compression: str, mode: str = 'wt'):
+    """Open path for writing through gzip, or zstd if the zstandard package is there.
+
+    With mode 'ab' the bytes written are compressed into a new member at the end of the file.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=6)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.open(path, mode)
+    raise ValueError(f'Did not expect compression \'{compression}\'')
+
+
+class Exporter:
+    """Makes compressed CSVs of whole log files or of a time range, one at a time.
+
+    A whole file is made again only if its source's mtime differs from the copy's (the copy
+    is given the source's mtime), except that a growing CSV just has what was added appended
+    and the binary log being written is made again at most every refresh_secs. A range is made
+    again only if a log file with rows in it has changed since, and then not until refresh_secs
+    after. Its end is rounded up to the minute, so asking again for one up to now finds it.
+    """
+
+    def __init__(self, datalogger: DataLogger, history: History, compression: str = 'gzip',
+                 refresh_secs: float = 300):
+        if compression not in SUFFIXES:
+            raise ValueError(f'Did not expect compression \'{compression}\'')
+        self.datalogger = datalogger
+        self.history = history
+        self.compression = compression
+        self.refresh_secs = refresh_secs
+        self.folder = datalogger.folder / Path('export')
+        # The size of each CSV when its copy was last brought up to date
+        self._sizes = {}
+        # When the copy of each binary log was last made
+        self._made = {}
+        self._ranges = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1, 'export')
+
+    def _path(self, name: str) -> Path:
+        if not self.folder.is_dir():
+            self.folder.mkdir()
+        return self.folder / f'{name}.csv{SUFFIXES[self.compression]}'
+
+    def _write(self, path: Path, lines):
+        """Stream lines into a compressed file, replacing path once it is complete."""
+        temp = path.with_suffix('.tmp')
+        with open_compressed(temp, self.compression) as fp:
+            fp.writelines(lines)
+        os.replace(temp, path)
+
+    def file(self, path: Path) -> Future:
+        """A Future of the compressed copy of a log file (.csv or .bin)."""
+        return self._executor.submit(self._file, path)
+
+    def _file(self, path: Path) -> Path:
+        if path == self.datalogger.fp:
+            self.datalogger.flush()
+        out = self._path(path.stem)
+        stat = path.stat()
+        mtime = stat.st_mtime_ns
+        meta = binlog.meta_path(path)
+        if path.suffix == '.bin' and meta.is_file():
+            mtime = max(mtime, meta.stat().st_mtime_ns)
+        if not out.is_file():
+            pass
+        elif out.stat().st_mtime_ns == mtime:
+            return out
+        elif path.suffix == '.bin':
+            made = self._made.get(path)
+            if path == self.datalogger.fp and made is not None and \
+                    timing.monotonic() - made < self.refresh_secs:
+                return out
+        elif self._sizes.get(path, stat.st_size) < stat.st_size:
+            self._append(path, out, stat.st_size, mtime)
+            return out
+        if path.suffix == '.bin':
+            self._write(out, binlog.export_csv(path, len(self.datalogger.names)))
+            self._made[path] = timing.monotonic()
+        else:
+            temp = out.with_suffix('.tmp')
+            with open(path, 'rb') as source, open_compressed(temp, self.compression, 'wb') as fp:
+                shutil.copyfileobj(source, fp)
+            os.replace(temp, out)
+            self._sizes[path] = stat.st_size
+        os.utime(out, ns=(mtime, mtime))
+        return out
+
+    def _append(self, path: Path, out: Path, size: int, mtime: int):
+        """Compress what has been added to path since the copy into a member on the end of it.
+
+        This goes to a copy of the copy first, so an upload of it in progress isn't disturbed.
+        """
+        temp = out.with_suffix('.tmp')
+        shutil.copyfile(out, temp)
+        with open(path, 'rb') as source, open_compressed(temp, self.compression, 'ab') as fp:
+            source.seek(self._sizes[path])
+            fp.write(source.read(size - self._sizes[path]))
+        os.replace(temp, out)
+        os.utime(out, ns=(mtime, mtime))
+        self._sizes[path] = size
+
+    def range(self, start: float, end: float, bucket_secs: float = None) -> Future:
+        """A Future of a compressed CSV of the rows in [start, end), or None if there are none.
+
+        With bucket_secs each row is the mean of a bucket of that many seconds instead.
+        """
+        start = math.floor(start)
+        end = math.ceil(end / 60) * 60
+        return self._executor.submit(self._range, start, end, bucket_secs)
+
+    def _range(self, start: float, end: float, bucket_secs: float):
+        self.datalogger.flush()
+        key = (start, end, bucket_secs)
+        sources = self.history.signature(start, end)
+        with self._lock:
+            cached = self._ranges.get(key)
+        if cached is not None and cached[2].is_file() and (
+                cached[0] == sources or timing.monotonic() - cached[1] < self.refresh_secs):
+            return cached[2]
+        if bucket_secs is None:
+            rows = self.history.rows(start, end)
+        else:
+            rows = ((b.start, [round(m, 4) for m in b.means])
+                    for b in self.history.downsample(start, end, bucket_secs))
+        lines = (f'\n{datetime.fromtimestamp(when).isoformat()},{",".join(map(str, values))}'
+                 for (when, values) in rows)
+        first = next(lines, None)
+        if first is None:
+            return None
+        name = f'range_{datetime.fromtimestamp(start):%Y%m%dT%H%M%S}_\
+{datetime.fromtimestamp(end):%Y%m%dT%H%M%S}'
+        if bucket_secs is not None:
+            name += f'_{bucket_secs:g}s'
+        out = self._path(name)
+        header = 'Time,' + ','.join(self.history.columns())
+        self._write(out, chain([header, first], lines))
+        with self._lock:
+            self._ranges[key] = (sources, timing.monotonic(), out)
+        return out
+
+    def cleanup(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,235 @@
+"""Forecasts logged channels from time of day/day of week profiles of their history."""
+from bisect import bisect_right
+from datetime import datetime, timedelta
+import json
+import numpy as np
+import os
+from pathlib import Path
+from query import History
+import threading
+import timing
+
+BUCKET_MINUTES = 15
+BUCKETS = 7 * 24 * 60 // BUCKET_MINUTES
+# kW per amp, the same conversion /statuskw uses
+KW_PER_AMP = 0.24
+# How many of the latest readings fit follows the residual over
+RESIDUAL_TAIL = 64
+
+
+def bucket(when: datetime) -> int:
+    """The week's BUCKET_MINUTES bucket that a time falls in."""
+    return (when.weekday() * 24 * 60 + when.hour * 60 + when.minute) // BUCKET_MINUTES
+
+
+class Profile:
+    """A weekly profile of each channel kept up to date with exponential smoothing.
+
+    Each reading nudges its bucket of the profile by alpha, while the difference between the
+    latest readings and the profile is smoothed by beta and decays by damping each bucket into
+    the future. The state is a fixed size whatever the amount of history it has seen.
+    """
+
+    def __init__(self, channels: int, alpha: float = 0.05, beta: float = 0.2,
+                 damping: float = 0.8):
+        self.channels = channels
+        self.alpha = alpha
+        self.beta = beta
+        self.damping = damping
+        self.profiles = np.zeros((channels, BUCKETS))
+        self.seen = np.zeros(BUCKETS, dtype=bool)
+        self.levels = np.zeros(channels)
+        self.residuals = np.zeros(channels)
+        self.last = None
+
+    def observe(self, values: list, when: datetime):
+        """Learn from one reading of every channel."""
+        self._update(bucket(when), np.asarray(values, dtype=float))
+        self.last = when
+
+    def _update(self, b: int, values: np.ndarray):
+        if not self.seen[b]:
+            self.profiles[:, b] = values
+            self.seen[b] = True
+        error = values - self.profiles[:, b]
+        self.profiles[:, b] += self.alpha * error
+        self.residuals += self.beta * (error - self.residuals)
+        self.levels += self.alpha * (values - self.levels)
+
+    def fit(self, buckets: np.ndarray, values: np.ndarray, last: datetime):
+        """Learn from a (readings, channels) array of readings in time order at once.
+
+        The profile and level come out as if each reading had been observed in turn. The
+        residual is only followed over the last RESIDUAL_TAIL readings, which are observed in
+        turn, as by then it has all but forgotten the readings before.
+        """
+        buckets = np.asarray(buckets)
+        values = np.asarray(values, dtype=float)
+        head = max(len(buckets) - RESIDUAL_TAIL, 0)
+        if head > 0:
+            self._fit(buckets[:head], values[:head])
+        for (b, value) in zip(buckets[head:], values[head:]):
+            self._update(b, value)
+        if len(buckets) > 0:
+            self.last = last if self.last is None else max(self.last, last)
+
+    def _fit(self, buckets: np.ndarray, values: np.ndarray):
+        keep = 1 - self.alpha
+        # How many later readings fall in the same bucket, which is how often each decays
+        order = np.argsort(buckets, kind='stable')
+        counts = np.bincount(buckets, minlength=BUCKETS)
+        starts = np.cumsum(counts) - counts
+        ranks = np.empty(len(buckets), dtype=np.int64)
+        ranks[order] = np.arange(len(buckets)) - starts[buckets[order]]
+        weights = self.alpha * keep ** (counts[buckets] - 1 - ranks)
+        # An unseen bucket starts at its first reading
+        priors = self.profiles.copy()
+        firsts = values[order[starts[counts > 0]]]
+        new = (counts > 0) & ~self.seen
+        priors[:, new] = firsts[new[counts > 0]].T
+        for i in range(self.channels):
+            self.profiles[i] = (keep ** counts * priors[i]
+                                + np.bincount(buckets, weights * values[:, i], BUCKETS))
+        self.seen |= counts > 0
+        decays = keep ** np.arange(len(buckets) - 1, -1, -1)
+        self.levels = keep ** len(buckets) * self.levels + self.alpha * decays @ values
+
+    def forecast(self, start: datetime, slots: int, slot_minutes: int) -> np.ndarray:
+        """Forecast each channel for the slots from start, as a (channels, slots) array."""
+        steps = np.arange(slots)
+        minute = start.weekday() * 24 * 60 + start.hour * 60 + start.minute
+        b = (minute + steps * slot_minutes) // BUCKET_MINUTES % BUCKETS
+        base = np.where(self.seen[b], self.profiles[:, b], self.levels[:, None])
+        decay = self.damping ** (steps * slot_minutes / BUCKET_MINUTES)
+        return base + self.residuals[:, None] * decay
+
+    def to_json(self) -> dict:
+        return {'profiles': self.profiles.tolist(), 'seen': self.seen.tolist(),
+                'levels': self.levels.tolist(), 'residuals': self.residuals.tolist(),
+                'last': None if self.last is None else self.last.isoformat()}
+
+    def load_json(self, state: dict):
+        profiles = np.array(state['profiles'], dtype=float)
+        if profiles.shape != (self.channels, BUCKETS):
+            raise ValueError(f'Expected {self.channels} profiles of {BUCKETS} buckets')
+        self.profiles = profiles
+        self.seen = np.array(state['seen'], dtype=bool)
+        self.levels = np.array(state['levels'], dtype=float)
+        self.residuals = np.array(state['residuals'], dtype=float)
+        self.last = None if state['last'] is None else datetime.fromisoformat(state['last'])
+
+
+class LoadForecast:
+    """Forecasts every logged channel (Solar, House, ...) in kW, and from them the estimate
+    from current_combine for the Scheduler.
+
+    The profile is saved to file save_secs after it first changes, and when it's trained on
+    the DataLogger history it only learns from rows logged since it was last saved. Readings
+    observed while it's training are held back and learnt from once it has finished, so the
+    profile always sees them in time order.
+    """
+
+    def __init__(self, current_types: list, file: Path = None, save_secs: float = 600):
+        self.current_types = current_types
+        self.file = file
+        self.save_secs = save_secs
+        self.profile = Profile(len(current_types))
+        self._signs = np.array([ct.value[0] for ct in current_types], dtype=float)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._timer = None
+        # What observe was given while training, None when not training
+        self._pending = None
+        if file is not None and file.is_file():
+            with open(file, 'r') as fp:
+                try:
+                    self.profile.load_json(json.load(fp))
+                except ValueError:
+                    # Saved for different channels, start again
+                    pass
+
+    def observe(self, currents: list, estimated: float, when: datetime):
+        values = [c * KW_PER_AMP for c in currents]
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((values, when))
+            else:
+                self.profile.observe(values, when)
+        self._schedule_save()
+
+    def channels(self, start: datetime, slots: int, slot_minutes: int) -> np.ndarray:
+        """Forecast each channel in kW, as a (channels, slots) array."""
+        with self._lock:
+            return self.profile.forecast(start, slots, slot_minutes)
+
+    def forecast(self, start: datetime, slots: int, slot_minutes: int) -> list:
+        """Forecast the estimate in kW, the sum of the channels as current_combine does."""
+        return (self._signs @ self.channels(start, slots, slot_minutes)).tolist()
+
+    def train(self, history: History, days: int = 28):
+        """Learn from the logged history since the last reading seen, going back at most days."""
+        with self._lock:
+            self._pending = []
+            seen = self.profile.last
+        times = []
+        buckets = []
+        values = []
+        try:
+            end = timing.now()
+            start = end - timedelta(days=days)
+            if seen is not None and seen > start:
+                start = seen + timedelta(seconds=1)
+            num = len(self.current_types)
+            for (when, row) in history.rows(start.timestamp(), end.timestamp()):
+                times.append(when)
+                buckets.append(bucket(datetime.fromtimestamp(when)))
+                values.append(row[:num])
+        finally:
+            with self._lock:
+                # Anything at or before the last reading seen is already in the profile, as is
+                # anything observed since that is older than what was read
+                first = 0 if self.profile.last is None else \
+                    bisect_right(times, self.profile.last.timestamp())
+                if first < len(times):
+                    self.profile.fit(np.array(buckets[first:]),
+                                     np.array(values[first:]) * KW_PER_AMP,
+                                     datetime.fromtimestamp(times[-1]))
+                for (observed, when) in self._pending:
+                    if self.profile.last is None or when > self.profile.last:
+                        self.profile.observe(observed, when)
+                self._pending = None
+        self._schedule_save()
+
+    def start_training(self, history: History, days: int = 28) -> threading.Thread:
+        """Train on a thread of its own, so the control loop can start meanwhile."""
+        thread = threading.Thread(target=self.train, args=(history, days), name='forecast',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _schedule_save(self):
+        with self._lock:
+            if self._timer is None and self.file is not None:
+                self._timer = threading.Timer(self.save_secs, self.save)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def save(self):
+        """Write the profile to file, replacing it atomically.
+
+        Only copying the profile holds up observe, the writing has a lock of its own.
+        """
+        with self._save_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if self.file is None:
+                    return
+                state = self.profile.to_json()
+            temp = self.file.with_suffix('.tmp')
+            with open(temp, 'w') as fp:
+                json.dump(state, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp, self.file)
@@ -1,9 +1,14 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import PARSEMODE_HTML as HTML
+from outbox import message_id
 from state import mode_shorthand
+import threading
 import timing
 
 class ChangeHandler:
+    # The info keys to be told about changes to, None being all of them
+    keys = None
+
     def should_update(self) -> bool:
         return False
 
@@ -14,30 +19,40 @@ class ChangeHandler:
         pass
 
 class LiveStatusHandler(ChangeHandler):
+    keys = ('currents', 'estimated', 'recommended', 'charge_rate', 'soc', 'mode')
+
     def __init__(self, tbot, chat_id: int, secs_for: int = 300, mes_id = None):
         self.tbot = tbot
         self.chat_id = chat_id
         self.live_until = timing.second_number() + secs_for
         self.last_stuff = (tbot.formatted_current(), tbot.modes._mode)
+        self.last_version = tbot.info.version
         mode = mode_shorthand(tbot.modes._mode)
         text = f'<b>LIVE ({mode})</b>\n{self.last_stuff[0]}\n'
         if mes_id is None:
-            mes = tbot.send_text(text, chat_id, parse_mode=HTML)
-            self.mes_id = mes.message_id
+            self.mes_id = tbot.send_text(text, chat_id, parse_mode=HTML)
         else:
             tbot.edit_message_text(text, chat_id, mes_id, parse_mode=HTML)
             self.mes_id = mes_id
         self.run_out = False
 
+    def _stuff(self) -> tuple:
+        return (self.tbot.formatted_current(), self.tbot.info['mode'])
+
     def should_update(self) -> bool:
-        return (self.tbot.formatted_current(), self.tbot.modes._mode) != self.last_stuff
+        # Nothing can have changed if the info hasn't, otherwise the text is shared by everyone
+        if self.tbot.info.version == self.last_version:
+            return False
+        self.last_version = self.tbot.info.version
+        return self._stuff() != self.last_stuff
 
     def update(self) -> bool:
-        self.last_stuff = (self.tbot.formatted_current(), self.tbot.modes._mode)
+        self.last_stuff = self._stuff()
         if timing.second_number() > self.live_until:
             message = self.last_stuff[0]
-            markup = InlineKeyboardMarkup([[
-                InlineKeyboardButton('Continue', callback_data=f'{self.chat_id} {self.mes_id}')]])
+            mes_id = message_id(self.mes_id)
+            markup = None if mes_id is None else InlineKeyboardMarkup([[
+                InlineKeyboardButton('Continue', callback_data=f'{self.chat_id} {mes_id}')]])
             self.run_out = True
         else:
             mode = mode_shorthand(self.last_stuff[1])
@@ -52,6 +67,8 @@ class LiveStatusHandler(ChangeHandler):
             self.tbot.edit_message_text(self.tbot.formatted_current(), self.chat_id, self.mes_id)
 
 class RecommendHandler(ChangeHandler):
+    keys = ('recommended',)
+
     def __init__(self, tbot, chat_id: int, secs_for = None):
         self.tbot = tbot
         self.chat_id = chat_id
@@ -75,11 +92,7 @@ class RecommendHandler(ChangeHandler):
             message = f'{self.tbot.info["recommended"]}A'
         else:
             message = 'N/A'
-        mes = self.tbot.send_text(f'Recommendation: {message}', self.chat_id)
-        if mes is None:
-            return None
-        else:
-            return mes.message_id
+        return self.tbot.send_text(f'Recommendation: {message}', self.chat_id)
 
     def update(self) -> bool:
         if self.is_finished():
@@ -93,3 +106,60 @@ class RecommendHandler(ChangeHandler):
 
     def remove(self):
         self.tbot.delete_message(self.chat_id, self.last_mes_id)
+
+class HandlerRegistry:
+    """The ChangeHandlers, indexed by the info keys they watch.
+
+    Adding and removing are O(1) and can happen while dispatching, since watching and
+    iterating give a copy of the handlers.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._everything = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def add(self, handler: ChangeHandler):
+        with self._lock:
+            if handler in self._handlers:
+                return
+            self._handlers[handler] = None
+            if handler.keys is None:
+                self._everything[handler] = None
+            else:
+                for key in handler.keys:
+                    self._by_key.setdefault(key, {})[handler] = None
+
+    def remove(self, handler: ChangeHandler) -> bool:
+        """Remove a handler, returning False if it wasn't there."""
+        with self._lock:
+            if handler not in self._handlers:
+                return False
+            del self._handlers[handler]
+            if handler.keys is None:
+                del self._everything[handler]
+            else:
+                for key in handler.keys:
+                    del self._by_key[key][handler]
+            return True
+
+    def watching(self, changed) -> list:
+        """The handlers watching any of the changed keys."""
+        if not self._handlers:
+            return []
+        with self._lock:
+            found = dict(self._everything)
+            for key in changed:
+                found.update(self._by_key.get(key, {}))
+        return list(found)
+
+    def __contains__(self, handler: ChangeHandler) -> bool:
+        return handler in self._handlers
+
+    def __len__(self) -> int:
+        return len(self._handlers)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._handlers))
@@ -1,21 +1,53 @@
 """Stores information in a json file, acting like a dictionary."""
 import json
+import os
 from pathlib import Path
+import threading
+
+# The general settings there are typed attributes for, with their types
+GENERAL = {'charge_cost_limit': float, 'discharge_value': float, 'min_discharge_rate': int,
+           'max_paid_soc': int, 'min_discharge_soc': int, 'pump_threshold': float,
+           'pump_subtractor': float}
+
+
+class GeneralSettings:
+    """The general settings as attributes of the right type, None if one hasn't been set."""
+
+    __slots__ = tuple(GENERAL)
+
+    def __init__(self, general: dict):
+        for name in GENERAL:
+            self.set(name, general.get(name))
+
+    def set(self, name: str, value):
+        setattr(self, name, None if value is None else GENERAL[name](value))
 
 
 class NonVolatileInformation:
-    """Used for storing chat information in a json file."""
+    """Used for storing chat information in a json file.
+
+    Reads are served from memory, the general settings in GENERAL also as typed attributes of
+    settings. Writes bump version and are saved a short delay later so a burst of changes is
+    only written once.
+    """
 
-    def __init__(self, file: Path):
+    def __init__(self, file: Path, delay: float = 2.0):
         """Get the information currently stored in the file."""
         self.file = file
+        self.delay = delay
         with open(self.file, 'r') as fp:
             self._info = json.load(fp)
         self.token = self._info['token']
+        self._general = self._info.setdefault('general', {})
+        self.settings = GeneralSettings(self._general)
+        self.version = 0
+        self._lock = threading.Lock()
+        self._timer = None
 
     def add_chat(self, chat_id: int):
         """Create a new chat with default information."""
-        self._info['chats'][str(chat_id)] = {'recommend': False}
+        with self._lock:
+            self._info['chats'][str(chat_id)] = {'recommend': False}
         self._update()
 
     def __getitem__(self, chat_id: int) -> dict:
@@ -24,27 +56,48 @@ class NonVolatileInformation:
 
     def setitem(self, chat_id: int, setting: str, new_val):
         """Set a piece of information about a given chat."""
-        self._info['chats'][str(chat_id)][setting] = new_val
+        with self._lock:
+            self._info['chats'][str(chat_id)][setting] = new_val
         self._update()
 
     def get_general(self, name: str, default: int = None):
-        if self._info.get('general') is None:
-            self._info['general'] = {}
-            self._update()
-        if (self._info['general'].get(name) is None):
+        value = self._general.get(name)
+        if value is None:
             return default
         else:
-            return self._info['general'][name]
+            return value
 
     def set_general(self, name: str, value):
-        if self._info.get('general') is None:
-            self._info['general'] = {}
-        self._info['general'][name] = value
+        with self._lock:
+            if name in GENERAL:
+                value = GENERAL[name](value)
+                self.settings.set(name, value)
+            self._general[name] = value
         self._update()
 
     def _update(self):
-        with open(self.file, 'w') as fp:
-            json.dump(self._info, fp)
+        with self._lock:
+            self.version += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Write any changes to the file, replacing it atomically.
+
+        The lock is held throughout, so the timer and cleanup can't both write the temp file.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            temp = self.file.with_suffix('.tmp')
+            with open(temp, 'w') as fp:
+                json.dump(self._info, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp, self.file)
 
     def is_valid(self, chat_id: int):
         """Check if a given chat id is validated."""
@@ -0,0 +1,230 @@
+"""Makes the Telegram API calls on a worker thread, within Telegram's rate limits."""
+from collections import OrderedDict
+from concurrent.futures import Future
+from itertools import count
+import logging
+from telegram.error import NetworkError, RetryAfter, TimedOut
+import threading
+import time
+
+
+def message_id(mes_id):
+    """The id of a message given either it or a Future of the Message, None if it isn't known."""
+    if isinstance(mes_id, Future):
+        if not mes_id.done() or mes_id.result() is None:
+            return None
+        return mes_id.result().message_id
+    return mes_id
+
+
+class TokenBucket:
+    """Allows burst calls at once and rate a second after that."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self._tokens + (now - self._last) * self.rate, self.burst)
+        self._last = now
+
+    def ready_at(self, now: float) -> float:
+        """When the next call is allowed."""
+        self._refill(now)
+        return now if self._tokens >= 1 else now + (1 - self._tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self._tokens -= 1
+
+
+class _Call:
+    def __init__(self, key, chat_id: int, mes_id, command, kwargs: dict):
+        self.key = key
+        self.chat_id = chat_id
+        self.mes_id = mes_id
+        self.command = command
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        self.after = 0.0
+
+    def blocked(self) -> bool:
+        """If the message it acts on hasn't been sent yet."""
+        return isinstance(self.mes_id, Future) and not self.mes_id.done()
+
+
+class Outbox:
+    """Queues sends, edits and deletes for a worker thread so callers never wait on Telegram.
+
+    Every call gives a Future of its result (None if it failed, or if it came after stop).
+    Queued edits of the same message are coalesced so only the latest is sent, in the place of
+    the latest, and deleting a message drops its queued edits. A message can be referred to by
+    the Future its send gave before it has been sent. Each chat keeps its order, limited to
+    chat_rate a second (after chat_burst at once) and global_rate a second overall.
+    NetworkErrors are retried up to retries times with a backoff doubling from min_backoff to
+    max_backoff seconds, except a send that timed out, which may have been sent after all.
+    """
+
+    def __init__(self, logger: logging.Logger, chat_rate: float = 1.0, chat_burst: int = 3,
+                 global_rate: float = 25.0, retries: int = 5, min_backoff: float = 1.0,
+                 max_backoff: float = 60.0):
+        self.logger = logger
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._global = TokenBucket(global_rate, int(global_rate))
+        self._chats = {}
+        self._queue = OrderedDict()
+        self._ids = count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._work, name='outbox', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Send whatever is queued (waiting at most timeout) and stop the worker.
+
+        Whatever is still queued after timeout is given up on.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        with self._cond:
+            calls = list(self._queue.values())
+            self._queue.clear()
+        for call in calls:
+            call.future.set_result(None)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _put(self, call: _Call) -> Future:
+        with self._cond:
+            return self._put_locked(call)
+
+    def _put_locked(self, call: _Call) -> Future:
+        if self._stopping:
+            call.future.set_result(None)
+            return call.future
+        queued = self._queue.get(call.key)
+        if queued is not None:
+            # Keep the queued call's Future, but send the latest version after anything queued
+            # since, so it can't overtake it
+            (queued.command, queued.kwargs) = (call.command, call.kwargs)
+            self._queue.move_to_end(call.key)
+            return queued.future
+        self._queue[call.key] = call
+        self._cond.notify()
+        return call.future
+
+    def send(self, chat: int, command, /, **kwargs) -> Future:
+        """Call command(**kwargs), which sends a new message to chat."""
+        return self._put(_Call(('send', next(self._ids)), chat, None, command, kwargs))
+
+    def edit(self, chat: int, mes, command, /, **kwargs) -> Future:
+        """Call command(message_id=..., **kwargs), replacing any edit of mes still queued."""
+        return self._put(_Call(('edit', chat, mes), chat, mes, command, kwargs))
+
+    def delete(self, chat: int, mes, command, /, **kwargs) -> Future:
+        """Call command(message_id=..., **kwargs), dropping any edits of mes still queued."""
+        with self._cond:
+            edit = self._queue.pop(('edit', chat, mes), None)
+            future = self._put_locked(_Call(('delete', chat, mes), chat, mes, command, kwargs))
+        if edit is not None:
+            edit.future.set_result(None)
+        return future
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self, now: float) -> tuple:
+        """Get (the call to make now or None, how long to wait otherwise or None for ever)."""
+        seen = set()
+        wait = None
+        for call in self._queue.values():
+            if call.chat_id in seen:
+                continue
+            seen.add(call.chat_id)
+            if call.blocked():
+                continue
+            ready = max(call.after, self._bucket(call.chat_id).ready_at(now),
+                        self._global.ready_at(now))
+            if ready <= now:
+                return (call, None)
+            wait = ready - now if wait is None else min(wait, ready - now)
+        return (None, wait)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping and self._queue == {}:
+                        return
+                    now = time.monotonic()
+                    (call, wait) = self._next(now)
+                    if call is not None:
+                        del self._queue[call.key]
+                        self._bucket(call.chat_id).take(now)
+                        self._global.take(now)
+                        break
+                    self._cond.wait(wait)
+            self._make(call)
+
+    def _make(self, call: _Call):
+        kwargs = call.kwargs
+        if call.mes_id is not None:
+            mes_id = message_id(call.mes_id)
+            if mes_id is None:
+                call.future.set_result(None)
+                return
+            kwargs = dict(kwargs, message_id=mes_id)
+        try:
+            # Not the arguments, they can be whole photos and documents
+            self.logger.info('%s(chat_id=%s, message_id=%s)', call.command.__name__,
+                             call.chat_id, kwargs.get('message_id'))
+            call.future.set_result(call.command(**kwargs))
+        except RetryAfter as e:
+            self._retry(call, e.retry_after)
+        except TimedOut:
+            if call.key[0] == 'send':
+                # Not safe to retry, Telegram may have got it and the message would be doubled
+                self.logger.warning('Timed out sending')
+                call.future.set_result(None)
+            else:
+                self._network_error(call)
+        except NetworkError:
+            self._network_error(call)
+        except:  # noqa
+            self.logger.exception('Telegram Bot:')
+            call.future.set_result(None)
+
+    def _network_error(self, call: _Call):
+        call.attempts += 1
+        if call.attempts > self.retries:
+            self.logger.warning('Network Error')
+            call.future.set_result(None)
+        else:
+            self._retry(call, min(self.min_backoff * 2 ** (call.attempts - 1), self.max_backoff))
+
+    def _retry(self, call: _Call, delay: float):
+        """Put a call back at the front, unless a newer version of it has been queued since."""
+        call.after = time.monotonic() + delay
+        with self._cond:
+            newer = self._queue.get(call.key)
+            if newer is None:
+                self._queue[call.key] = call
+                self._queue.move_to_end(call.key, last=False)
+                self._cond.notify()
+                return
+        newer.future.add_done_callback(lambda f: call.future.set_result(f.result()))
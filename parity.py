@@ -0,0 +1,63 @@
+"""Random samples and the scalar pipeline replayed over them, to check and time batch against.
+
+test_batch.py and benchmarks/batch.py both use these.
+"""
+from config import Config
+from current import CurrentType, current_combine
+from datetime import datetime
+from hysteresis import OnOff
+import json
+from nvi import NonVolatileInformation
+import numpy as np
+from pathlib import Path
+from recommend import Recommend, energy_price
+from simulate import DEFAULTS, LOGGER, SimQuasar
+from state import Mode, Modes
+import timing
+
+NAMES = ['A', 'B', 'C', 'D', 'E']
+TYPES = [CurrentType.Source, CurrentType.Drain, CurrentType.Unknown, CurrentType.Drain,
+         CurrentType.Unknown]
+
+
+def make_config(folder: Path) -> Config:
+    return Config(folder, NAMES, TYPES, **DEFAULTS, logger=LOGGER)
+
+
+def samples(n: int, lowest_soc: int = 0) -> tuple:
+    """Random currents (with some exact halves), times over a year and SoCs (some unknown)."""
+    rng = np.random.default_rng(0)
+    currents = np.round(rng.normal(0, 8, (n, len(TYPES))), 2)
+    currents[::7] = np.round(currents[::7] * 2) / 2
+    times = datetime(2022, 1, 1).timestamp() + np.sort(rng.uniform(0, 365 * 86400, n))
+    socs = rng.integers(lowest_soc, 101, n)
+    if lowest_soc == 0:
+        socs[::11] = 0
+    return (currents, times, socs)
+
+
+def replay(folder: Path, mode: Mode, settings: dict, currents, times, socs) -> tuple:
+    """Run the scalar pipeline over the samples, giving its outputs, Config and final Policy."""
+    config = make_config(folder)
+    with open(folder / 'settings.json', 'w') as fp:
+        json.dump({'token': '', 'chats': {}, 'general': settings}, fp)
+    quasar = SimQuasar()
+    modes = Modes(config, mode, NonVolatileInformation(folder / 'settings.json'), quasar)
+    recommend = Recommend(config)
+    hysteresis = OnOff(4)
+    out = ([], [], [], [])
+    clock = timing.FixedClock()
+    timing.set_clock(clock)
+    try:
+        for (row, when, soc) in zip(currents.tolist(), times.tolist(), socs.tolist()):
+            clock.set(when)
+            quasar.level = soc
+            estimated = current_combine(row, TYPES)
+            recommended = recommend.current(estimated, modes, quasar)
+            out[0].append(estimated)
+            out[1].append(energy_price(config))
+            out[2].append(recommended)
+            out[3].append(hysteresis.balance(recommended))
+    finally:
+        timing.set_clock(None)
+    return (out, config, modes.policy())
@@ -1,6 +1,7 @@
 from enum import Enum
 from pyModbusTCP.client import ModbusClient
-import time
+import threading
+import timing
 
 class QuasarStatus(Enum):
     READY = 0
@@ -16,10 +17,46 @@ class QuasarStatus(Enum):
     INQUEUE_POWER_BOOST = 10
     DISCHARGING = 11
 
+# Contiguous register blocks that are read with a single request
+READ_BLOCKS = [(0x200, 0x21A)]
+# How many seconds a register read as part of a block stays valid for
+REGISTER_TTL = {0x200: 10, 0x202: 10, 0x219: 5, 0x21A: 120}
+DEFAULT_TTL = 5
+# How many seconds reads of a block wait after failing to refresh it before trying again
+FAILED_TTL = 10
+# Reconnection backoff limits and how long the link may idle before it is probed
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+HEALTH_INTERVAL = 30
+
+class ConnectionStats:
+    def __init__(self):
+        self.connects = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.requests = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency: float):
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def __str__(self) -> str:
+        mean = 0.0 if self.requests == 0 else self.total_latency / self.requests
+        return f'''\
+Connects: {self.connects}
+Reconnects: {self.reconnects}
+Failures: {self.failures}
+Requests: {self.requests}
+Mean latency: {round(mean * 1000, 1)}ms
+Max latency: {round(self.max_latency * 1000, 1)}ms'''
+
 def write(f):
     def wrapper(self, *args, **kwargs):
         if self._disconnected is not None:
-            if self._disconnected < time.time():
+            if self._disconnected < timing.monotonic():
                 self._disconnected = None
                 if self._controlling:
                     self.take_control()
@@ -29,35 +66,170 @@ def write(f):
     return wrapper
 
 class Quasar:
-    def __init__(self, host: str, port: int = 502):
-        self._client = ModbusClient(host=host, port=port, auto_open=True, auto_close=True)
+    def __init__(self, host: str, port: int = 502, persistent: bool = True):
+        self.persistent = persistent
+        self._client = ModbusClient(host=host, port=port, auto_open=not persistent,
+                                    auto_close=not persistent)
+        self._lock = threading.RLock()
+        self.stats = ConnectionStats()
+        self._backoff = MIN_BACKOFF
+        self._next_attempt = 0.0
+        self._last_success = 0.0
         self._charging = None
         self.current = None
         self._soc = 0
         self._disconnected = None
         self._controlling = False
-        self._last_read_soc = 0.0
+        self._snapshot = {}
+        self._retry = {}
+        self._pending = {}
+        self._forced = set()
+        self._confirmed = {}
 
     def take_control(self):
         self._controlling = True
         self.write_register(0x51, 1)
         self.stop_charging(True)
+        self.flush()
 
     def relinquish_control(self):
         self._controlling = False
         self.stop_charging(True)
         self.write_register(0x51, 0)
+        self.flush()
+
+    def _connect(self) -> bool:
+        if self._client.is_open:
+            return True
+        now = timing.monotonic()
+        if now < self._next_attempt:
+            return False
+        if self._client.open():
+            if self.stats.connects > 0:
+                self.stats.reconnects += 1
+            self.stats.connects += 1
+            self._backoff = MIN_BACKOFF
+            return True
+        self._next_attempt = now + self._backoff
+        self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+        # Skip writes until the next attempt, control is retaken once it has passed
+        if self._disconnected is None or self._disconnected < self._next_attempt:
+            self._disconnected = self._next_attempt
+        self.current = None
+        self._charging = None
+        self._confirmed = {}
+        return False
+
+    def _request(self, method, *args):
+        """Run a client request, reopening the persistent connection if it dropped."""
+        with self._lock:
+            for _ in range(2 if self.persistent else 1):
+                if self.persistent and not self._connect():
+                    return None
+                start = timing.monotonic()
+                result = method(*args)
+                if result is not None and result is not False:
+                    self._last_success = timing.monotonic()
+                    self.stats.record(self._last_success - start)
+                    return result
+                self.stats.failures += 1
+                if self.persistent:
+                    self._client.close()
+            return None
+
+    def check_connection(self):
+        """Probe the connection if it has been idle, which also refreshes the snapshot."""
+        if self.persistent and self._last_success + HEALTH_INTERVAL < timing.monotonic():
+            self.refresh()
+
+    def _block_for(self, address: int):
+        for block in READ_BLOCKS:
+            if block[0] <= address <= block[1]:
+                return block
+        return None
+
+    def refresh(self, blocks: list = READ_BLOCKS) -> bool:
+        """Read each block in one request and store it in the snapshot."""
+        success = True
+        for (start, end) in blocks:
+            regs = self._request(self._client.read_holding_registers, start, end - start + 1)
+            now = timing.monotonic()
+            if regs is None:
+                self._retry[(start, end)] = now + FAILED_TTL
+                success = False
+                continue
+            self._retry.pop((start, end), None)
+            for (i, value) in enumerate(regs):
+                address = start + i
+                self._snapshot[address] = (value, now + REGISTER_TTL.get(address, DEFAULT_TTL))
+            if start <= 0x219 <= end:
+                self._check_confirmed(regs[0x219 - start])
+        return success
+
+    def _check_confirmed(self, status: int):
+        # Forget the confirmed action if the charger has since changed it on its own
+        charging = status in (QuasarStatus.CHARGING.value, QuasarStatus.DISCHARGING.value)
+        if self._confirmed.get(0x101) == (2 if charging else 1):
+            del self._confirmed[0x101]
 
     def read_register(self, address: int) -> int:
-        reg = self._client.read_holding_registers(address)
-        if reg is None:
-            return 0
-        else:
-            return reg[0]
+        block = self._block_for(address)
+        if block is None:
+            reg = self._request(self._client.read_holding_registers, address)
+            if reg is None:
+                return 0
+            else:
+                return reg[0]
+        cached = self._snapshot.get(address)
+        now = timing.monotonic()
+        if cached is None or cached[1] < now:
+            if now < self._retry.get(block, 0) or not self.refresh([block]):
+                return 0
+            cached = self._snapshot[address]
+        return cached[0]
 
     @write
-    def write_register(self, address: int, value: int):
-        self._client.write_single_register(address, value)
+    def write_register(self, address: int, value: int, force: bool = False):
+        """Queue a write, only the latest value per register is sent by flush.
+
+        Unless force is set the write is skipped if the charger has already confirmed the
+        value, which is only as current as the last snapshot.
+        """
+        with self._lock:
+            self._pending[address] = value
+            if force:
+                self._forced.add(address)
+
+    def flush(self):
+        """Send the queued writes the charger hasn't already confirmed.
+
+        Contiguous registers go out together in one request, otherwise the writes
+        keep the order their registers were first queued in.
+        """
+        with self._lock:
+            order = list(self._pending)
+            writes = {a: v for (a, v) in self._pending.items()
+                      if a in self._forced or self._confirmed.get(a) != v}
+            self._pending = {}
+            self._forced = set()
+            runs = []
+            for address in sorted(writes):
+                if runs != [] and runs[-1][-1] == address - 1:
+                    runs[-1].append(address)
+                else:
+                    runs.append([address])
+            runs.sort(key=lambda run: min(order.index(a) for a in run))
+            for run in runs:
+                values = [writes[a] for a in run]
+                if len(run) == 1:
+                    success = self._request(self._client.write_single_register, run[0], values[0])
+                else:
+                    success = self._request(self._client.write_multiple_registers, run[0], values)
+                for (address, value) in zip(run, values):
+                    if success:
+                        self._confirmed[address] = value
+                    else:
+                        self._confirmed.pop(address, None)
 
     @write
     def start_charging(self):
@@ -68,7 +240,8 @@ class Quasar:
     def stop_charging(self, unchecked: bool = False):
         if unchecked or self._charging != False:
             self.soc
-            self.write_register(0x101, 2)
+            # An unchecked stop goes out even if a stale snapshot says it's already stopped
+            self.write_register(0x101, 2, force=unchecked)
             self._charging = False
 
     @write
@@ -95,11 +268,9 @@ class Quasar:
 
     @property
     def soc(self) -> int:
-        if self._last_read_soc < time.time():
-            self._last_read_soc = time.time() + 120
-            reading = self._read_state_of_charge()
-            if reading != 0:
-                self._soc = reading
+        reading = self._read_state_of_charge()
+        if reading != 0:
+            self._soc = reading
         return self._soc
 
     @property
@@ -119,7 +290,9 @@ class Quasar:
         self.set_charge_rate(3)
         self.relinquish_control()
         self._controlling = control
-        self._disconnected = time.time() + seconds
+        self._confirmed = {}
+        self._disconnected = timing.monotonic() + seconds
 
     def cleanup(self):
         self.relinquish_control()
+        self._client.close()
@@ -0,0 +1,288 @@
+"""Time range queries over the CSV and binary log files written by DataLogger."""
+import binlog
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+from state import Mode, mode_shorthand
+import timing
+
+# How many rows there are between entries in a file's index
+CHUNK_ROWS = 256
+
+
+class FileIndex:
+    """The time and byte offset of every CHUNK_ROWS-th row of one CSV log file."""
+
+    def __init__(self, path: Path):
+        """Read the header, the index itself is built by update."""
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.header = fp.readline().decode().rstrip('\n').split(',')
+            self._data_start = fp.tell()
+        self.columns = [h.split('(')[0] for h in self.header[1:self.header.index('Metadata')]]
+        self.times = []
+        self.offsets = []
+        self.last = None
+        self.size = 0
+        self.mtime = 0
+
+    def update(self):
+        """Index any rows added since the last update, rescanning only the final chunk."""
+        stat = self.path.stat()
+        if (stat.st_size, stat.st_mtime) == (self.size, self.mtime):
+            return
+        if stat.st_size < self.size:
+            self.times = []
+            self.offsets = []
+        if self.offsets != []:
+            start = self.offsets.pop()
+            self.times.pop()
+        else:
+            start = self._data_start
+        with open(self.path, 'rb') as fp:
+            fp.seek(start)
+            i = 0
+            while True:
+                offset = fp.tell()
+                line = fp.readline()
+                if line == b'':
+                    break
+                try:
+                    when = row_time(line)
+                except ValueError:
+                    continue
+                if i % CHUNK_ROWS == 0:
+                    self.times.append(when)
+                    self.offsets.append(offset)
+                self.last = when
+                i += 1
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+
+    @property
+    def first(self):
+        return None if self.times == [] else self.times[0]
+
+    def chunk_end(self, chunk: int) -> int:
+        return self.offsets[chunk + 1] if chunk + 1 < len(self.offsets) else self.size
+
+    def parse_chunk(self, data: bytes) -> list:
+        """Parse the rows in a chunk's bytes into (time, values, mode)."""
+        num = len(self.columns) - 3
+        rows = []
+        for line in data.decode().split('\n'):
+            try:
+                rows.append(parse_row(line, num))
+            except (ValueError, IndexError):
+                pass
+        return rows
+
+
+class BinIndex(FileIndex):
+    """The time and byte offset of every CHUNK_ROWS-th record of one binary log file.
+
+    Records are a fixed size, so only the first of each chunk needs reading to index it.
+    """
+
+    def __init__(self, path: Path):
+        """Read the header from the .meta file, the index itself is built by update."""
+        self.path = path
+        self.header = binlog.read_header(path).split(',')
+        self.columns = [h.split('(')[0] for h in self.header[1:self.header.index('Metadata')]]
+        self._record = binlog.record_struct(len(self.columns) - 3)
+        self.times = []
+        self.offsets = []
+        self.last = None
+        self.size = 0
+        self.mtime = 0
+
+    def update(self):
+        """Index any records added since the last update, leaving out a partly written one."""
+        stat = self.path.stat()
+        size = stat.st_size - stat.st_size % self._record.size
+        if (size, stat.st_mtime) == (self.size, self.mtime):
+            return
+        if size < self.size:
+            self.times = []
+            self.offsets = []
+        chunk_bytes = CHUNK_ROWS * self._record.size
+        with open(self.path, 'rb') as fp:
+            for offset in range(len(self.offsets) * chunk_bytes, size, chunk_bytes):
+                fp.seek(offset)
+                self.times.append(float(self._record.unpack(fp.read(self._record.size))[0]))
+                self.offsets.append(offset)
+            if size > 0:
+                fp.seek(size - self._record.size)
+                self.last = float(self._record.unpack(fp.read(self._record.size))[0])
+        self.size = size
+        self.mtime = stat.st_mtime
+
+    def parse_chunk(self, data: bytes) -> list:
+        num = len(self.columns) - 3
+        rows = []
+        for record in self._record.iter_unpack(data):
+            # Rounded as export_csv does, so a value reads the same as it would from a CSV
+            values = [round(c, 4) for c in record[1:num + 1]]
+            values.append(float(record[num + 1]))
+            values.append(float(record[num + 3]))
+            rows.append((float(record[0]), values, mode_shorthand(Mode(record[num + 2]))))
+        return rows
+
+
+def row_time(line: bytes) -> float:
+    """Get the time of a row, raising ValueError if it isn't one."""
+    return datetime.fromisoformat(line.split(b',', 1)[0].decode()).timestamp()
+
+
+def parse_time(text: str, default: datetime = None) -> datetime:
+    """Parse 'HH:MM' (on the default's day, otherwise today) or an ISO date/datetime."""
+    if len(text) <= 5 and ':' in text:
+        (hour, minute) = text.split(':')
+        day = timing.now() if default is None else default
+        return day.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    return datetime.fromisoformat(text)
+
+
+def parse_range(args: list) -> tuple:
+    """Parse '<start> [end]' into epoch times, a lone date covers the whole day."""
+    start = parse_time(args[0])
+    if len(args) > 1:
+        end = parse_time(args[1], start)
+    elif ':' in args[0]:
+        end = timing.now()
+    else:
+        end = start + timedelta(days=1)
+    return (start.timestamp(), end.timestamp())
+
+
+def parse_row(line: str, num: int) -> tuple:
+    """Split a row into (time, values, mode), the values being the currents, Recommended and
+    SoC and the mode its shorthand."""
+    fields = line.rstrip('\n').split(',')
+    values = [float(f) for f in fields[1:num + 2]]
+    values.append(float(fields[num + 3]))
+    return (datetime.fromisoformat(fields[0]).timestamp(), values, fields[num + 2])
+
+
+class Bucket:
+    """Summary of the rows in one time bucket."""
+
+    def __init__(self, start: float, width: int):
+        self.start = start
+        self.count = 0
+        self.mins = [float('inf')] * width
+        self.maxs = [float('-inf')] * width
+        self.totals = [0.0] * width
+
+    def add(self, values: list):
+        self.count += 1
+        for (i, v) in enumerate(values):
+            if v < self.mins[i]:
+                self.mins[i] = v
+            if v > self.maxs[i]:
+                self.maxs[i] = v
+            self.totals[i] += v
+
+    @property
+    def means(self) -> list:
+        return [t / self.count for t in self.totals]
+
+
+class History:
+    """Queries over every log file in the DataLogger folder, CSV or binary.
+
+    Files are indexed incrementally as they grow and parsed chunks of rows are kept in an LRU
+    cache.
+    """
+
+    def __init__(self, folder: Path, cache_chunks: int = 64):
+        self.folder = folder
+        self.cache_chunks = cache_chunks
+        self._indexes = {}
+        self._chunks = OrderedDict()
+
+    def indexes(self) -> list:
+        """Get an up to date index of each log file, in time order."""
+        for path in self.folder.glob('*.csv'):
+            if path not in self._indexes:
+                self._indexes[path] = FileIndex(path)
+        for path in self.folder.glob('*.bin'):
+            # DataLogger writes the .meta file with the header first
+            if path not in self._indexes and binlog.meta_path(path).is_file():
+                self._indexes[path] = BinIndex(path)
+        for path in list(self._indexes):
+            if not path.is_file():
+                del self._indexes[path]
+            else:
+                self._indexes[path].update()
+        indexes = [index for index in self._indexes.values() if index.first is not None]
+        indexes.sort(key=lambda index: index.first)
+        return indexes
+
+    def columns(self) -> list:
+        """The names of the values in each row."""
+        indexes = self.indexes()
+        if indexes == []:
+            return []
+        return indexes[-1].columns[:-2] + ['SoC']
+
+    def signature(self, start: float, end: float) -> tuple:
+        """The name, size and mtime of each file with rows in [start, end), to tell when any
+        of them changes."""
+        return tuple((index.path.name, index.size, index.mtime) for index in self.indexes()
+                     if index.last >= start and index.first < end)
+
+    def _chunk(self, index: FileIndex, chunk: int) -> list:
+        key = (index.path, chunk, index.chunk_end(chunk))
+        rows = self._chunks.get(key)
+        if rows is not None:
+            self._chunks.move_to_end(key)
+            return rows
+        with open(index.path, 'rb') as fp:
+            fp.seek(index.offsets[chunk])
+            rows = index.parse_chunk(fp.read(index.chunk_end(chunk) - index.offsets[chunk]))
+        self._chunks[key] = rows
+        if len(self._chunks) > self.cache_chunks:
+            self._chunks.popitem(last=False)
+        return rows
+
+    def rows(self, start: float, end: float):
+        """Yield each (time, values) with start <= time < end, across files."""
+        for (when, values, _) in self.rows_with_mode(start, end):
+            yield (when, values)
+
+    def rows_with_mode(self, start: float, end: float):
+        """Yield each (time, values, mode) with start <= time < end, across files."""
+        for index in self.indexes():
+            if index.last < start or index.first >= end:
+                continue
+            chunk = max(bisect_left(index.times, start) - 1, 0)
+            while chunk < len(index.offsets) and index.times[chunk] < end:
+                for row in self._chunk(index, chunk):
+                    if start <= row[0] < end:
+                        yield row
+                chunk += 1
+
+    def modes(self, start: float, end: float) -> list:
+        """Get (time, mode shorthand) for the first row in [start, end) and each change after."""
+        changes = []
+        for (when, _, mode) in self.rows_with_mode(start, end):
+            if changes == [] or changes[-1][1] != mode:
+                changes.append((when, mode))
+        return changes
+
+    def downsample(self, start: float, end: float, bucket_secs: float) -> list:
+        """Summarise the rows in [start, end) into buckets, leaving out empty buckets."""
+        buckets = {}
+        for (when, values) in self.rows(start, end):
+            n = int((when - start) // bucket_secs)
+            if n not in buckets:
+                buckets[n] = Bucket(start + n * bucket_secs, len(values))
+            buckets[n].add(values)
+        return [buckets[n] for n in sorted(buckets)]
+
+    def summary(self, start: float, end: float):
+        """Summarise all the rows in [start, end) as one Bucket, or None if there are none."""
+        buckets = self.downsample(start, end, end - start)
+        return None if buckets == [] else buckets[0]
@@ -1,19 +1,23 @@
 from config import Config
 from math import ceil, floor
 from quasar import Quasar
-from state import State
+from scheduler import Scheduler
+from state import Mode, Modes
 import timing
 
 def energy_price(config: Config):
-    if ((timing.past_this_time(config.night_start) and not timing.past_this_time(config.night_end))
-            or (config.secondary_night_start is not None and timing.past_this_time(config.secondary_night_start))):
-        return config.night_rate
-    else:
-        return config.day_rate
+    return config.tariff.price_at(timing.now())
 
 class Recommend:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, scheduler: Scheduler = None):
+        """In AUTO, a scheduler (if given) decides when to charge from or discharge to the grid."""
         self.config = config
+        self.scheduler = scheduler
+
+    def observe(self, currents: list, estimated: float):
+        """Let the scheduler's forecast learn from a tick, whatever the mode."""
+        if self.scheduler is not None:
+            self.scheduler.observe(currents, estimated, timing.now())
 
     def round_estimation(self, estimated: float, frac: float, minimum: int = 3) -> int:
         positive = abs(estimated)
@@ -33,28 +37,45 @@ class Recommend:
         else:
             return value
 
-    def current(self, estimated: float, state: State, quasar: Quasar) -> int:
+    def current(self, estimated: float, modes: Modes, quasar: Quasar, soc: int = None) -> int:
+        """Recommend a charge rate, reading the SoC from quasar unless it is given."""
+        policy = modes.policy()
         cur_price = energy_price(self.config)
-        charge_cost_limit = state.charge_cost_limit
-        if state.max_soc_bounds != [] and quasar.soc != 0:
-            for boundary in state.max_soc_bounds:
-                if quasar.soc >= boundary[0]:
-                    charge_cost_limit = boundary[1]
+        if soc is None:
+            soc = quasar.soc
+        planning = self.scheduler is not None and modes._mode == Mode.AUTO
+        # The plan's targets depend on whether today is a winter day, so keep that up to date
+        if planning and modes.observe_soc(soc):
+            policy = modes.policy()
+        charge_cost_limit = policy.charge_limit(soc)
         if cur_price < charge_cost_limit:
             return 32
+        if planning:
+            return self.follow_plan(estimated, modes, policy, soc, cur_price, charge_cost_limit)
         if estimated <= 0:
             return self.round_estimation(estimated, 1 - min(charge_cost_limit / cur_price, 1), 3)
         else:
-            if estimated < 3:
-                discharge_value = state.low_discharge_value
-            else:
-                discharge_value = state.discharge_value
-            if state.min_soc_bounds != [] and quasar.soc != 0:
-                for boundary in state.min_soc_bounds:
-                    if quasar.soc <= boundary[0]:
-                        discharge_value = boundary[1]
+            if modes.observe_soc(soc):
+                policy = modes.policy()
+            discharge_value = policy.discharge_limit(estimated, soc)
             if cur_price < discharge_value:
                 return 0
             else:
                 return self.round_estimation(estimated, min(discharge_value / cur_price, 1),
-                                             state.min_discharge_rate)
+                                             policy.min_discharge_rate)
+
+    def follow_plan(self, estimated: float, modes: Modes, policy, soc: int, cur_price: float,
+                    charge_cost_limit: float) -> int:
+        """Charge when the plan does, otherwise soak up any excess and only discharge as far as
+        the plan allows and the house actually needs."""
+        now = timing.now()
+        planned = self.scheduler.planned_current(now, soc, self.config.min_charge,
+                                                 modes.auto.max_charge())
+        if planned > 0:
+            return planned
+        if estimated <= 0:
+            return self.round_estimation(estimated, 1 - min(charge_cost_limit / cur_price, 1), 3)
+        if planned < 0:
+            frac = min(policy.discharge_limit(estimated, soc) / cur_price, 1)
+            return max(planned, self.round_estimation(estimated, frac, policy.min_discharge_rate))
+        return 0
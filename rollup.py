@@ -0,0 +1,111 @@
+"""Hourly and daily energy totals, kept up to date as the data is logged."""
+from config import Config
+from datetime import datetime, timedelta
+import json
+import os
+from pathlib import Path
+from recommend import energy_price
+import threading
+import timing
+
+# kW per amp, the same conversion /statuskw uses
+KW_PER_AMP = 0.24
+
+
+def empty_totals(width: int) -> dict:
+    return {'import': [0.0] * width, 'export': [0.0] * width, 'cost': [0.0] * width}
+
+
+def add_totals(totals: dict, other: dict):
+    for key in totals:
+        totals[key] = [a + b for (a, b) in zip(totals[key], other[key])]
+
+
+class EnergyRollup:
+    """Integrates each channel, plus the estimate from current_combine, into hourly and daily
+    kWh and cost totals.
+
+    Positive readings count as import and negative ones as export. Only the estimate is what
+    actually comes from the grid, so only its import is priced. The totals are written to a
+    small JSON store whenever the hour changes and at least every save_secs.
+    """
+
+    def __init__(self, config: Config, file: Path, max_gap: float = 60, keep_hours: int = 24 * 62,
+                 save_secs: float = 300):
+        """Load any totals already in the store."""
+        self.config = config
+        self.file = file
+        self.names = config.names + ['Estimated']
+        self.max_gap = max_gap
+        self.keep_hours = keep_hours
+        self.save_secs = save_secs
+        self._lock = threading.Lock()
+        self._last = None
+        self._last_save = timing.monotonic()
+        if file.is_file():
+            with open(file, 'r') as fp:
+                self._store = json.load(fp)
+        else:
+            self._store = {'hours': {}, 'days': {}}
+
+    def add(self, currents: list, estimated: float, when: datetime):
+        """Add the energy since the previous reading, gaps longer than max_gap are skipped."""
+        last = self._last
+        self._last = when
+        if last is None:
+            return
+        secs = (when - last).total_seconds()
+        if secs <= 0 or secs > self.max_gap:
+            return
+        price = energy_price(self.config)
+        hour = f'{when:%Y-%m-%dT%H}'
+        estimate = len(self.names) - 1
+        with self._lock:
+            new_hour = hour not in self._store['hours']
+            for (period, key) in [('hours', hour), ('days', f'{when:%Y-%m-%d}')]:
+                totals = self._store[period].setdefault(key, empty_totals(len(self.names)))
+                for (i, current) in enumerate(currents + [estimated]):
+                    kwh = current * KW_PER_AMP * secs / 3600
+                    if kwh >= 0:
+                        totals['import'][i] += kwh
+                        if i == estimate:
+                            totals['cost'][i] += kwh * price
+                    else:
+                        totals['export'][i] -= kwh
+        if new_hour or timing.monotonic() - self._last_save >= self.save_secs:
+            self.save()
+
+    def totals(self, period: str, keys: list) -> dict:
+        """Sum the totals of the given hours or days."""
+        totals = empty_totals(len(self.names))
+        with self._lock:
+            for key in keys:
+                if key in self._store[period]:
+                    add_totals(totals, self._store[period][key])
+        return totals
+
+    def days(self, end: datetime, count: int) -> dict:
+        """Sum the daily totals of count days up to and including end."""
+        return self.totals('days', [f'{end - timedelta(days=i):%Y-%m-%d}' for i in range(count)])
+
+    def save(self):
+        """Write the store atomically, dropping hours older than keep_hours."""
+        with self._lock:
+            cutoff = f'{timing.now() - timedelta(hours=self.keep_hours):%Y-%m-%dT%H}'
+            self._store['hours'] = {k: v for (k, v) in self._store['hours'].items()
+                                    if k >= cutoff}
+            temp = self.file.with_suffix('.tmp')
+            with open(temp, 'w') as fp:
+                json.dump(self._store, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp, self.file)
+            self._last_save = timing.monotonic()
+
+    def summary_text(self, totals: dict) -> str:
+        message = []
+        for (i, name) in enumerate(self.names):
+            message.append(f'{name}: {round(totals["import"][i], 2)}kWh in, \
+{round(totals["export"][i], 2)}kWh out')
+        message[-1] += f', {round(totals["cost"][-1])}p'
+        return '\n'.join(message)
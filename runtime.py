@@ -0,0 +1,176 @@
+"""Runs the control loop as asyncio tasks linked by bounded queues."""
+import asyncio
+from commands import TeleCommands
+from concurrent.futures import ThreadPoolExecutor, wait
+from current import CurrentMonitor, current_combine
+from datalogger import DataLogger
+from hysteresis import CarConnect, Misalignment, OnOff
+from quasar import Quasar
+from recommend import Recommend
+from state import Mode
+import time
+import timing
+
+STAGES = ['serial', 'control', 'charger', 'log', 'notify']
+
+
+class StageMetrics:
+    """Latency of one stage of the loop and how many items it has dropped."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.dropped = 0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def __str__(self) -> str:
+        mean = 0.0 if self.count == 0 else self.total / self.count
+        return f'{round(self.last * 1000, 1)}ms last, {round(mean * 1000, 1)}ms mean, \
+{round(self.max * 1000, 1)}ms max, {self.dropped} dropped'
+
+
+class Metrics:
+    def __init__(self, names: list = STAGES):
+        self.stages = {name: StageMetrics() for name in names}
+
+    def __getitem__(self, name: str) -> StageMetrics:
+        return self.stages[name]
+
+    def __str__(self) -> str:
+        return '\n'.join([f'{name}: {stage}' for (name, stage) in self.stages.items()])
+
+
+def offer(queue: asyncio.Queue, item, stage: StageMetrics):
+    """Put an item on the queue without waiting, dropping the oldest item if it is full."""
+    if queue.full():
+        queue.get_nowait()
+        stage.dropped += 1
+    queue.put_nowait(item)
+
+
+class Runtime:
+    """Serial ingest, recommendation, charger I/O, logging and notifications as separate tasks.
+
+    Only the recommendation step runs on the event loop, everything that can block runs in its
+    own single thread so a slow consumer just drops its oldest queued item. The charger takes
+    every tick queued since its last step so CarConnect and Misalignment see them all (unless
+    more than queue_size came in during a step), but only acts on the latest charge rate. The
+    SoC the recommendation uses is the one the charger thread last read, so the event loop
+    never waits on Modbus. On the way out a charger step in progress gets up to shutdown_secs
+    to finish, so a Modbus write isn't left half done.
+    """
+
+    def __init__(self, current_types: list, current_monitor: CurrentMonitor,
+                 recommend: Recommend, on_off: OnOff, car_connect: CarConnect,
+                 misalignment: Misalignment, data_logger: DataLogger, quasar: Quasar,
+                 commands: TeleCommands, queue_size: int = 4, shutdown_secs: float = 5):
+        self.current_types = current_types
+        self.current_monitor = current_monitor
+        self.recommend = recommend
+        self.on_off = on_off
+        self.car_connect = car_connect
+        self.misalignment = misalignment
+        self.data_logger = data_logger
+        self.quasar = quasar
+        self.commands = commands
+        self.queue_size = queue_size
+        self.shutdown_secs = shutdown_secs
+        self.metrics = Metrics()
+        # 0 is an unknown SoC until the charger thread has read it
+        self.soc = 0
+        self._settings_version = None
+        self._executors = {name: ThreadPoolExecutor(1, name)
+                           for name in ['serial', 'charger', 'log', 'notify']}
+
+    async def _in_thread(self, name: str, func, *args):
+        start = time.perf_counter()
+        ret = await asyncio.get_running_loop().run_in_executor(self._executors[name], func, *args)
+        self.metrics[name].record(time.perf_counter() - start)
+        return ret
+
+    async def _serial(self):
+        while True:
+            currents = await self._in_thread('serial', self.current_monitor.read)
+            offer(self.samples, currents, self.metrics['serial'])
+
+    async def _control(self):
+        tbot = self.commands.tbot
+        while True:
+            currents = await self.samples.get()
+            start = time.perf_counter()
+            timing.tick()
+            if tbot.nvinfo.version != self._settings_version:
+                self._settings_version = tbot.nvinfo.version
+                settings = tbot.nvinfo.settings
+                self._pump_threshold = (99 if settings.pump_threshold is None
+                                        else settings.pump_threshold)
+                self._pump_subtractor = (0 if settings.pump_subtractor is None
+                                         else settings.pump_subtractor)
+            if currents[3] > self._pump_threshold:
+                currents[3] -= self._pump_subtractor
+
+            estimated = current_combine(currents, self.current_types)
+            self.recommend.observe(currents, estimated)
+            recommended = self.recommend.current(estimated, tbot.modes, self.quasar, self.soc)
+            charge_rate = self.on_off.balance(recommended)
+
+            offer(self.charger, (charge_rate, currents[2], tbot.modes._mode),
+                  self.metrics['charger'])
+            offer(self.log, (currents, recommended, tbot.modes._mode, self.soc),
+                  self.metrics['log'])
+            offer(self.notify, (currents, estimated, recommended, charge_rate, self.soc),
+                  self.metrics['notify'])
+            self.metrics['control'].record(time.perf_counter() - start)
+
+    def _charger_step(self, ticks: list):
+        """Check every tick for the car, then set the latest charge rate and publish the SoC."""
+        for (charge_rate, car_reading, _) in ticks:
+            self.car_connect.check(self.quasar, charge_rate, car_reading)
+            self.misalignment.check(self.quasar, charge_rate, car_reading)
+        (charge_rate, _, mode) = ticks[-1]
+        if mode != Mode.OFF:
+            self.quasar.set_charge_rate(charge_rate)
+        self.quasar.flush()
+        self.quasar.check_connection()
+        self.soc = self.quasar.soc
+
+    async def _charger(self):
+        while True:
+            ticks = [await self.charger.get()]
+            while not self.charger.empty():
+                ticks.append(self.charger.get_nowait())
+            await self._in_thread('charger', self._charger_step, ticks)
+
+    def _log_step(self, currents: list, recommended: int, mode: Mode, soc: int):
+        self.data_logger.tick(currents, recommended, mode, soc)
+
+    async def _log(self):
+        while True:
+            await self._in_thread('log', self._log_step, *await self.log.get())
+
+    async def _notify(self):
+        while True:
+            await self._in_thread('notify', self.commands.tbot.update_info, *await self.notify.get())
+
+    async def run(self):
+        """Run every stage until one of them raises."""
+        self.samples = asyncio.Queue(self.queue_size)
+        self.charger = asyncio.Queue(self.queue_size)
+        self.log = asyncio.Queue(self.queue_size)
+        self.notify = asyncio.Queue(self.queue_size)
+        try:
+            await asyncio.gather(self._serial(), self._control(), self._charger(), self._log(),
+                                 self._notify())
+        finally:
+            # Queued behind any charger step in progress, so it's done once that is
+            charger = self._executors['charger'].submit(lambda: None)
+            for executor in self._executors.values():
+                executor.shutdown(wait=False)
+            wait([charger], timeout=self.shutdown_secs)
@@ -0,0 +1,187 @@
+"""Plans the cheapest way to charge and discharge the car over the coming day."""
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from datetime import datetime, timedelta
+
+# kW per amp, the same conversion /statuskw uses
+KW_PER_AMP = 0.24
+SLOT_MINUTES = 15
+AMP_OPTIONS = (-16, -10, -6, -3, 0, 3, 6, 10, 16, 32)
+
+
+class FlatForecast:
+    """Forecasts the house's net load (estimated, in kW) as an exponentially smoothed level."""
+
+    def __init__(self, alpha: float = 0.01):
+        self.alpha = alpha
+        self.level = None
+
+    def observe(self, currents: list, estimated: float, when: datetime):
+        kw = estimated * KW_PER_AMP
+        if self.level is None:
+            self.level = kw
+        else:
+            self.level += self.alpha * (kw - self.level)
+
+    def forecast(self, start: datetime, slots: int, slot_minutes: int) -> list:
+        return [0.0 if self.level is None else self.level] * slots
+
+
+class Plan:
+    """The amps to use in each slot from start and the SoC expected at the start of each."""
+
+    def __init__(self, start: datetime, amps: list, socs: list, loads: list, key: tuple):
+        self.start = start
+        self.amps = amps
+        self.socs = socs
+        self.loads = loads
+        self.key = key
+
+    def slot(self, when: datetime) -> int:
+        return int((when - self.start).total_seconds() // (SLOT_MINUTES * 60))
+
+
+class Scheduler:
+    """Solves for the cheapest charge/discharge plan over the horizon with dynamic programming.
+
+    The SoC is split into levels and each slot picks one of AMP_OPTIONS, charging is paid for
+    at the tariff's rate less whatever the forecast load leaves spare, discharging saves buying
+    for the load and exporting earns export_rate. Energy left in the car at the end is valued at
+    the cheapest rate in the horizon, and ending below min_soc costs twice the dearest rate to
+    charge for, so the plan always gets back up to it. The plan is solved again at each slot
+    boundary, or sooner if the SoC or targets drift from what it was solved for. With
+    background the solving happens on a worker thread and planned_current uses the latest
+    finished plan meanwhile.
+    """
+
+    def __init__(self, config: Config, capacity: float = 40.0, forecaster=None,
+                 horizon: int = 24 * 60 // SLOT_MINUTES, levels: int = 400,
+                 export_rate: float = 0.0, soc_tolerance: float = 5.0, background: bool = True):
+        self.config = config
+        self.capacity = capacity
+        self.forecaster = FlatForecast() if forecaster is None else forecaster
+        self.horizon = horizon
+        self.levels = levels
+        self.export_rate = export_rate
+        self.soc_tolerance = soc_tolerance
+        self.plan = None
+        self._executor = ThreadPoolExecutor(1, 'scheduler') if background else None
+        self._solving = None
+
+    def observe(self, currents: list, estimated: float, when: datetime):
+        self.forecaster.observe(currents, estimated, when)
+
+    def _slot_start(self, when: datetime) -> datetime:
+        minute = when.minute - when.minute % SLOT_MINUTES
+        return when.replace(minute=minute, second=0, microsecond=0)
+
+    def _level_changes(self) -> list:
+        hours = SLOT_MINUTES / 60
+        step = self.capacity / self.levels
+        changes = []
+        for amps in AMP_OPTIONS:
+            kwh = amps * KW_PER_AMP * hours
+            if amps > 0:
+                kwh *= self.config.efficiency
+            changes.append(round(kwh / step))
+        return changes
+
+    def _inputs(self, start: datetime) -> tuple:
+        """The price and forecast load of each slot from start."""
+        prices = [self.config.tariff.price_at(start + timedelta(minutes=SLOT_MINUTES * i))
+                  for i in range(self.horizon)]
+        return (prices, self.forecaster.forecast(start, self.horizon, SLOT_MINUTES))
+
+    def solve(self, when: datetime, soc: float, min_soc: float, max_soc: float) -> Plan:
+        """Find the cheapest plan from the slot containing when."""
+        start = self._slot_start(when)
+        return self._optimise(start, *self._inputs(start), soc, min_soc, max_soc)
+
+    def _optimise(self, start: datetime, prices: list, loads: list, soc: float, min_soc: float,
+                  max_soc: float) -> Plan:
+        hours = SLOT_MINUTES / 60
+        slots = len(prices)
+        changes = self._level_changes()
+        step = self.capacity / self.levels
+        lowest = round(min_soc / 100 * self.levels)
+        highest = round(max_soc / 100 * self.levels)
+        terminal = min(prices) * step
+        shortfall = 2 * max(prices) / self.config.efficiency * step
+        values = [-level * terminal + max(lowest - level, 0) * shortfall
+                  for level in range(self.levels + 1)]
+        choices = []
+        for t in range(slots - 1, -1, -1):
+            costs = []
+            for (amps, change) in zip(AMP_OPTIONS, changes):
+                net = loads[t] * hours + amps * KW_PER_AMP * hours
+                costs.append(prices[t] * net if net > 0 else self.export_rate * net)
+            new_values = [0.0] * (self.levels + 1)
+            best = [0] * (self.levels + 1)
+            for level in range(self.levels + 1):
+                best_value = None
+                for (i, change) in enumerate(changes):
+                    after = level + change
+                    if (change < 0 and after < lowest) or (change > 0 and after > highest):
+                        continue
+                    if after < 0 or after > self.levels:
+                        continue
+                    value = costs[i] + values[after]
+                    if best_value is None or value < best_value:
+                        best_value = value
+                        best[level] = i
+                new_values[level] = best_value
+            values = new_values
+            choices.append(best)
+        choices.reverse()
+        level = min(max(round(soc / 100 * self.levels), 0), self.levels)
+        amps = []
+        socs = []
+        for t in range(slots):
+            socs.append(level * 100 / self.levels)
+            i = choices[t][level]
+            amps.append(AMP_OPTIONS[i])
+            level += changes[i]
+        return Plan(start, amps, socs, loads, (min_soc, max_soc, self.config.tariff))
+
+    def _stale(self, when: datetime, soc: float, min_soc: float, max_soc: float) -> bool:
+        plan = self.plan
+        if plan is None or plan.key != (min_soc, max_soc, self.config.tariff):
+            return True
+        if plan.slot(when) != 0:
+            return True
+        return soc != 0 and abs(soc - plan.socs[0]) > self.soc_tolerance
+
+    def _finished(self, future):
+        if future.cancelled():
+            pass
+        elif future.exception() is None:
+            self.plan = future.result()
+        else:
+            self.config.logger.error('Solving the plan failed:', exc_info=future.exception())
+        self._solving = None
+
+    def planned_current(self, when: datetime, soc: float, min_soc: float, max_soc: float) -> int:
+        """The amps the plan wants now, solving again first if it has gone stale.
+
+        An SoC of 0 is unknown, in which case the plan is only solved again once it is known.
+        In the background this never waits, it uses the last plan until the new one is ready.
+        """
+        if soc != 0 and self._solving is None and self._stale(when, soc, min_soc, max_soc):
+            if self._executor is None:
+                self.plan = self.solve(when, soc, min_soc, max_soc)
+            else:
+                # The forecast is read here, only the optimising happens on the worker
+                start = self._slot_start(when)
+                self._solving = self._executor.submit(self._optimise, start, *self._inputs(start),
+                                                      soc, min_soc, max_soc)
+                self._solving.add_done_callback(self._finished)
+        if self.plan is None:
+            return 0
+        slot = self.plan.slot(when)
+        if 0 <= slot < len(self.plan.amps):
+            return self.plan.amps[slot]
+        return 0
+
+    def cleanup(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
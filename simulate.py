@@ -0,0 +1,253 @@
+"""Replays logged data through the recommendation and hysteresis logic against a simulated car.
+
+Run from the repository root, e.g.
+    python -m simulate data --start 2022-05-01 --end 2022-06-01
+    python -m simulate data --mode AUTO --sweep on_off=2,4,6 --sweep discharge_value=20,25
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from current import CurrentType, current_combine
+from datetime import datetime
+from hysteresis import CarConnect, Misalignment, OnOff
+from itertools import product
+import json
+import logging
+from nvi import NonVolatileInformation
+from pathlib import Path
+from query import History
+from quasar import QuasarStatus
+from recommend import Recommend, energy_price
+from scheduler import Scheduler
+from state import Mode, Modes
+import tempfile
+import timing
+
+# Warnings go to stderr, rather than setting up the root logger of whatever imports this
+LOGGER = logging.getLogger('simulate')
+if LOGGER.handlers == []:
+    LOGGER.addHandler(logging.StreamHandler())
+    LOGGER.setLevel(logging.WARNING)
+    LOGGER.propagate = False
+# kW per amp, the same conversion /statuskw uses
+KW_PER_AMP = 0.24
+# The rates and times __main__ runs with
+DEFAULTS = {'day_rate': 30.6, 'night_rate': 7.5, 'efficiency': 0.8, 'night_start': (0, 0),
+            'night_end': (5, 30), 'min_charge': 40, 'summer_max_charge': 80,
+            'winter_max_charge': 90, 'secondary_night_start': (23, 30)}
+SETTINGS = ['charge_cost_limit', 'discharge_value', 'min_discharge_rate', 'max_paid_soc',
+            'min_discharge_soc']
+
+
+class SimQuasar:
+    """Stands in for Quasar, charging and discharging a battery of a given size."""
+
+    def __init__(self, capacity: float = 40.0, soc: float = 60.0, efficiency: float = 0.8):
+        self.capacity = capacity
+        self.level = soc
+        self.efficiency = efficiency
+        self.current = None
+        self.rate = 0
+        self._controlling = False
+
+    @property
+    def soc(self) -> int:
+        return round(self.level)
+
+    @property
+    def charger_status(self) -> QuasarStatus:
+        if self.rate > 0:
+            return QuasarStatus.CHARGING
+        elif self.rate < 0:
+            return QuasarStatus.DISCHARGING
+        else:
+            return QuasarStatus.PAUSED_BY_USER
+
+    def take_control(self):
+        self._controlling = True
+        self.stop_charging(True)
+
+    def relinquish_control(self):
+        self._controlling = False
+        self.stop_charging(True)
+
+    def stop_charging(self, unchecked: bool = False):
+        self.rate = 0
+
+    def set_charge_rate(self, amps: int):
+        if self.current == amps:
+            return
+        self.current = amps
+        self.rate = 0 if abs(amps) < 3 else amps
+
+    def flush(self):
+        pass
+
+    def check_connection(self):
+        pass
+
+    def step(self, secs: float) -> float:
+        """Run for some seconds, returning the kWh drawn (negative if supplied) by the car."""
+        if (self.rate > 0 and self.level >= 100) or (self.rate < 0 and self.level <= 0):
+            return 0.0
+        kwh = self.rate * KW_PER_AMP * secs / 3600
+        stored = kwh * self.efficiency if kwh > 0 else kwh
+        self.level = min(max(self.level + stored / self.capacity * 100, 0), 100)
+        return kwh
+
+
+class Totals:
+    def __init__(self):
+        self.imported = 0.0
+        self.exported = 0.0
+        self.cost = 0.0
+        self.charged = 0.0
+        self.discharged = 0.0
+        self.samples = 0
+
+    def as_dict(self) -> dict:
+        return {'imported_kwh': round(self.imported, 3), 'exported_kwh': round(self.exported, 3),
+                'cost_p': round(self.cost, 1), 'car_charged_kwh': round(self.charged, 3),
+                'car_discharged_kwh': round(self.discharged, 3), 'samples': self.samples}
+
+
+def load_types(history: History) -> tuple:
+    """Get the channel names and CurrentTypes from the newest file's header."""
+    indexes = history.indexes()
+    if indexes == []:
+        raise ValueError(f'No log files in {history.folder}')
+    names = []
+    types = []
+    for column in indexes[-1].header[1:indexes[-1].header.index('Recommended')]:
+        (name, kind) = column.rstrip(')').split('(')
+        names.append(name)
+        types.append(CurrentType[kind])
+    return (names, types)
+
+
+def simulate(folder: Path, start: float, end: float, params: dict) -> dict:
+    """Replay the logs between start and end with the given parameters, returning totals."""
+    history = History(folder)
+    (names, types) = load_types(history)
+    with tempfile.TemporaryDirectory() as work:
+        return replay(history, Path(work), names, types, start, end, params)
+
+
+def replay(history: History, work: Path, names: list, types: list, start: float, end: float,
+           params: dict) -> dict:
+    """Run the simulation with the config and settings kept in work."""
+    options = {k: params.get(k, v) for (k, v) in DEFAULTS.items()}
+    config = Config(work, names, types, options['day_rate'], options['night_rate'],
+                    options['efficiency'], tuple(options['night_start']),
+                    tuple(options['night_end']), options['min_charge'],
+                    options['summer_max_charge'], options['winter_max_charge'],
+                    tuple(options['secondary_night_start']), logger=LOGGER)
+    with open(work / 'settings.json', 'w') as fp:
+        json.dump({'token': '', 'chats': {}, 'general': {s: params[s] for s in SETTINGS
+                                                         if s in params}}, fp)
+    nvi = NonVolatileInformation(work / 'settings.json')
+    quasar = SimQuasar(params.get('capacity', 40.0), params.get('soc', 60.0),
+                       options['efficiency'])
+    modes = Modes(config, Mode.OFF, nvi, quasar)
+    modes.set_mode(Mode[params.get('mode', 'CHARGE_DISCHARGE')])
+    scheduler = (Scheduler(config, quasar.capacity, background=False) if params.get('scheduler')
+                 else None)
+    recommend = Recommend(config, scheduler)
+    on_off = OnOff(params.get('on_off', 4))
+    car_connect = CarConnect(10)
+    misalignment = Misalignment(10)
+    export_rate = params.get('export_rate', 0.0)
+    max_gap = params.get('max_gap', 60)
+    totals = Totals()
+    last = None
+    clock = timing.FixedClock(start)
+    timing.set_clock(clock)
+    try:
+        for (when, values) in history.rows(start, end):
+            clock.set(when)
+            if last is not None:
+                secs = min(when - last[0], max_gap)
+                car_kwh = quasar.step(secs)
+                grid_kwh = last[1] * KW_PER_AMP * secs / 3600 + car_kwh
+                if grid_kwh >= 0:
+                    totals.imported += grid_kwh
+                    totals.cost += grid_kwh * energy_price(config)
+                else:
+                    totals.exported -= grid_kwh
+                    totals.cost += grid_kwh * export_rate
+                if car_kwh >= 0:
+                    totals.charged += car_kwh
+                else:
+                    totals.discharged -= car_kwh
+            currents = values[:len(names)]
+            estimated = current_combine(currents, types)
+            recommend.observe(currents, estimated)
+            recommended = recommend.current(estimated, modes, quasar)
+            charge_rate = on_off.balance(recommended)
+            car_connect.check(quasar, charge_rate, abs(quasar.rate))
+            misalignment.check(quasar, charge_rate, abs(quasar.rate))
+            if modes._mode != Mode.OFF:
+                quasar.set_charge_rate(charge_rate)
+            last = (when, estimated)
+            totals.samples += 1
+    finally:
+        timing.set_clock(None)
+    return dict(totals.as_dict(), final_soc=quasar.soc)
+
+
+def _run(job: tuple) -> tuple:
+    (folder, start, end, params) = job
+    return (params, simulate(folder, start, end, params))
+
+
+def sweep(folder: Path, start: float, end: float, base: dict, grid: dict,
+          processes: int = None) -> list:
+    """Simulate every combination of the grid's values over a process pool."""
+    keys = list(grid)
+    jobs = [(folder, start, end, dict(base, **dict(zip(keys, values))))
+            for values in product(*[grid[k] for k in keys])]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(_run, jobs))
+
+
+def parse_value(text: str):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('folder', type=Path, help='the DataLogger folder to replay')
+    parser.add_argument('--start', default='2000-01-01')
+    parser.add_argument('--end', default='2100-01-01')
+    parser.add_argument('--mode', default='CHARGE_DISCHARGE', choices=[m.name for m in Mode])
+    parser.add_argument('--scheduler', action='store_true', help='plan AUTO with the Scheduler')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help=f'a parameter, e.g. on_off, capacity, soc or one of {SETTINGS}')
+    parser.add_argument('--sweep', action='append', default=[], metavar='NAME=V1,V2',
+                        help='sweep a parameter over some values')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    start = datetime.fromisoformat(args.start).timestamp()
+    end = datetime.fromisoformat(args.end).timestamp()
+    base = {'mode': args.mode, 'scheduler': args.scheduler}
+    for item in args.set:
+        (name, value) = item.split('=')
+        base[name] = parse_value(value)
+    if args.sweep == []:
+        print(json.dumps(simulate(args.folder, start, end, base)))
+    else:
+        grid = {}
+        for item in args.sweep:
+            (name, values) = item.split('=')
+            grid[name] = [parse_value(v) for v in values.split(',')]
+        for (params, totals) in sweep(args.folder, start, end, base, grid, args.processes):
+            print(json.dumps({k: params[k] for k in grid}), json.dumps(totals))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Sample sources that stand in for the Lechacal's serial port in CurrentMonitor.
+
+A source only needs readline, returning one line as bytes or b'' if there wasn't one yet.
+"""
+import os
+from pathlib import Path
+from query import History
+import time
+
+
+def format_line(currents: list, node: int = 11) -> bytes:
+    """Write currents as the Lechacal does, in watts after the node id and followed by Vrms."""
+    return f'{node} {" ".join([repr(c * 240) for c in currents])} 240.0\r\n'.encode()
+
+
+def open_pty() -> tuple:
+    """Open a pseudo-terminal, returning (the writing end, the path to read it from)."""
+    (master, slave) = os.openpty()
+    return (os.fdopen(master, 'wb', buffering=0), os.ttyname(slave))
+
+
+class FileSource:
+    """Reads lines from a file, FIFO or pseudo-terminal, waiting at the end for more to come."""
+
+    def __init__(self, path: Path, poll: float = 0.1):
+        self.path = path
+        self.poll = poll
+        self._fp = open(path, 'rb')
+
+    def readline(self) -> bytes:
+        line = self._fp.readline()
+        if line == b'':
+            time.sleep(self.poll)
+        return line
+
+    def close(self):
+        self._fp.close()
+
+
+class ReplaySource:
+    """Replays the currents DataLogger logged as Lechacal lines.
+
+    Rows come out rate times faster than they were logged, or as fast as they are read if rate
+    is None. Once they run out it gives b'' (after waiting poll), unless loop starts it over.
+    """
+
+    def __init__(self, folder: Path, start: float = 0.0, end: float = float('inf'),
+                 rate: float = 1.0, loop: bool = False, poll: float = 0.1):
+        self.history = History(folder)
+        # The columns end with Recommended and SoC
+        self.num = len(self.history.columns()) - 2
+        self.start = start
+        self.end = end
+        self.rate = rate
+        self.loop = loop
+        self.poll = poll
+        self.finished = False
+        self.replayed = 0
+        self._rows = None
+
+    def _restart(self):
+        self._rows = self.history.rows(self.start, self.end)
+        self._first = None
+
+    def readline(self) -> bytes:
+        if self._rows is None:
+            self._restart()
+        row = None if self.finished else next(self._rows, None)
+        if row is None and self.loop and self.replayed > 0 and not self.finished:
+            self._restart()
+            row = next(self._rows, None)
+        if row is None:
+            self.finished = True
+            time.sleep(self.poll)
+            return b''
+        (when, values) = row
+        if self.rate is not None:
+            if self._first is None:
+                self._first = (when, time.monotonic())
+            wait = self._first[1] + (when - self._first[0]) / self.rate - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.replayed += 1
+        return format_line(values[:self.num])
+
+    def close(self):
+        """Stop replaying, readline only gives b'' from now on."""
+        self.finished = True
@@ -1,3 +1,4 @@
+from bisect import bisect_left, bisect_right
 from enum import Enum
 from config import Config
 from nvi import NonVolatileInformation
@@ -8,11 +9,22 @@ class UserSettings:
     def __init__(self, config: Config, nvi: NonVolatileInformation):
         self.config = config
         self.nvi = nvi
-        self.low_discharge_value = config.low_day
+        self._low_discharge_value = config.low_day
+        self.changes = 0
+
+    @property
+    def low_discharge_value(self) -> float:
+        return self._low_discharge_value
+
+    @low_discharge_value.setter
+    def low_discharge_value(self, value: float):
+        self._low_discharge_value = value
+        self.changes += 1
 
     @property
     def charge_cost_limit(self) -> float:
-        return 0.0 if self.nvi.get_general('charge_cost_limit') is None else self.nvi.get_general('charge_cost_limit')
+        value = self.nvi.settings.charge_cost_limit
+        return 0.0 if value is None else value
 
     @charge_cost_limit.setter
     def charge_cost_limit(self, value: float):
@@ -20,7 +32,8 @@ class UserSettings:
 
     @property
     def discharge_value(self) -> float:
-        return self.config.low_day if self.nvi.get_general('discharge_value') is None else self.nvi.get_general('discharge_value')
+        value = self.nvi.settings.discharge_value
+        return self.config.low_day if value is None else value
 
     @discharge_value.setter
     def discharge_value(self, value: float):
@@ -28,26 +41,29 @@ class UserSettings:
 
     @property
     def min_discharge_rate(self) -> int:
-        return 3 if self.nvi.get_general('min_discharge_rate') is None else self.nvi.get_general('min_discharge_rate')
+        value = self.nvi.settings.min_discharge_rate
+        return 3 if value is None else value
 
     @min_discharge_rate.setter
     def min_discharge_rate(self, value: int):
         self.nvi.set_general('min_discharge_rate', value)
 
     @property
-    def max_paid_soc(self) -> float:
-        return self.config.summer_max_charge if self.nvi.get_general('max_paid_soc') is None else self.nvi.get_general('max_paid_soc')
+    def max_paid_soc(self) -> int:
+        value = self.nvi.settings.max_paid_soc
+        return self.config.summer_max_charge if value is None else value
 
     @max_paid_soc.setter
-    def max_paid_soc(self, value: float):
+    def max_paid_soc(self, value: int):
         self.nvi.set_general('max_paid_soc', value)
 
     @property
-    def min_discharge_soc(self) -> float:
-        return self.config.low_day if self.nvi.get_general('min_discharge_soc') is None else self.nvi.get_general('min_discharge_soc')
+    def min_discharge_soc(self) -> int:
+        value = self.nvi.settings.min_discharge_soc
+        return self.config.low_day if value is None else value
 
     @min_discharge_soc.setter
-    def min_discharge_soc(self, value: float):
+    def min_discharge_soc(self, value: int):
         self.nvi.set_general('min_discharge_soc', value)
 
     def ccl(self):
@@ -127,6 +143,51 @@ class State:
             return self._low_discharge_value()
 
 
+class Policy:
+    """A State with everything resolved, so deciding on a recommendation is just comparisons.
+
+    The SoC boundaries are sorted with the value each threshold gives precomputed, matching the
+    last boundary in the State's list that applies, so they can be searched with bisect.
+    """
+
+    __slots__ = ('charge_cost_limit', 'discharge_value', 'low_discharge_value',
+                 'min_discharge_rate', '_max_thresholds', '_max_values', '_min_thresholds',
+                 '_min_values')
+
+    def __init__(self, state: State):
+        self.charge_cost_limit = state.charge_cost_limit
+        self.discharge_value = state.discharge_value
+        self.low_discharge_value = state.low_discharge_value
+        self.min_discharge_rate = state.min_discharge_rate
+        max_bounds = list(enumerate(state.max_soc_bounds))
+        self._max_thresholds = sorted({b[0] for (_, b) in max_bounds})
+        self._max_values = [max([(i, b[1]) for (i, b) in max_bounds if b[0] <= t])[1]
+                            for t in self._max_thresholds]
+        min_bounds = list(enumerate(state.min_soc_bounds))
+        self._min_thresholds = sorted({b[0] for (_, b) in min_bounds})
+        self._min_values = [max([(i, b[1]) for (i, b) in min_bounds if b[0] >= t])[1]
+                            for t in self._min_thresholds]
+
+    def charge_limit(self, soc: int) -> float:
+        """The charge cost limit at this SoC, an SoC of 0 is unknown."""
+        if soc != 0:
+            i = bisect_right(self._max_thresholds, soc)
+            if i > 0:
+                return self._max_values[i - 1]
+        return self.charge_cost_limit
+
+    def discharge_limit(self, estimated: float, soc: int) -> float:
+        """The discharge value for this estimate at this SoC, an SoC of 0 is unknown."""
+        if soc != 0:
+            i = bisect_left(self._min_thresholds, soc)
+            if i < len(self._min_thresholds):
+                return self._min_values[i]
+        if estimated < 3:
+            return self.low_discharge_value
+        else:
+            return self.discharge_value
+
+
 class Auto:
     def __init__(self, config: Config, quasar: Quasar):
         self.config = config
@@ -136,20 +197,28 @@ class Auto:
     def charge_cost_limit(self) -> float:
         return self.config.high_night
 
-    def discharge_value(self) -> float:
+    def observe_soc(self, soc: int) -> bool:
+        """Mark today as a winter day once the SoC is down to min_charge, returning if it wasn't."""
         day_num = timing.comparison_day_number()
-        if self.quasar.soc <= self.config.min_charge:
+        if soc <= self.config.min_charge and self.winter_day != day_num:
             self.winter_day = day_num
-        if self.winter_day != day_num: # SUMMER
+            return True
+        return False
+
+    def discharge_value(self) -> float:
+        if self.winter_day != timing.comparison_day_number(): # SUMMER
             return self.config.discharge_rate
         else: # WINTER
             return self.config.low_day
 
-    def max_soc_bounds(self) -> list:
+    def max_charge(self) -> int:
         if self.winter_day != timing.comparison_day_number(): # SUMMER
-            return [(self.config.summer_max_charge, self.config.low_night)]
+            return self.config.summer_max_charge
         else: # WINTER
-            return [(self.config.winter_max_charge, self.config.low_night)]
+            return self.config.winter_max_charge
+
+    def max_soc_bounds(self) -> list:
+        return [(self.max_charge(), self.config.low_night)]
 
     def min_soc_bounds(self) -> list:
         return [(self.config.min_charge, self.config.high_day)]
@@ -168,8 +237,10 @@ class Modes:
     def __init__(self, config: Config, mode: Mode, nvi: NonVolatileInformation, quasar: Quasar):
         user_settings = UserSettings(config, nvi)
         self.user_settings = user_settings
+        self.nvi = nvi
         self.quasar = quasar
         auto = Auto(config, quasar)
+        self.auto = auto
         self.modes = {
             # Mode.OFF shows up as CHARGE_DISCHARGE for recommendation
             Mode.OFF: State(user_settings.ccl, user_settings.sdv, user_settings.mdr,
@@ -184,6 +255,8 @@ class Modes:
                              auto.max_soc_bounds, auto.min_soc_bounds, auto.discharge_value)
         }
         self._mode = mode
+        self._policy = None
+        self._policy_key = None
 
     def set_mode(self, new_mode: Mode):
         if new_mode == Mode.OFF:
@@ -195,3 +268,16 @@ class Modes:
     @property
     def state(self) -> State:
         return self.modes[self._mode]
+
+    def policy(self) -> Policy:
+        """Get the current mode's Policy, compiling it again if anything it uses has changed."""
+        key = (self._mode, self.nvi.version, self.user_settings.changes,
+               timing.comparison_day_number(), self.auto.winter_day)
+        if key != self._policy_key:
+            self._policy = Policy(self.state)
+            self._policy_key = key
+        return self._policy
+
+    def observe_soc(self, soc: int) -> bool:
+        """Let AUTO track the SoC while discharging, returning if the policy has changed."""
+        return self._mode == Mode.AUTO and self.auto.observe_soc(soc)
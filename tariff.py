@@ -0,0 +1,84 @@
+"""Time of use tariffs, precomputed into a sorted list of rate changes for each day."""
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+
+MINUTES_IN_DAY = 24 * 60
+
+
+def minute_of_day(when: tuple) -> int:
+    return when[0] * 60 + when[1]
+
+
+class Tariff:
+    """A default rate with any number of (start, end, rate) bands on top, times being
+    (hour, minute) and (24, 0) meaning midnight at the end of the day.
+
+    A band that ends before it starts runs past midnight and later bands win where they overlap.
+    Weekends can have their own bands, otherwise they use the weekday ones.
+    """
+
+    def __init__(self, default_rate: float, bands: list, weekend_bands: list = None):
+        """Precompute the rate changes for weekdays and weekends."""
+        self.default_rate = default_rate
+        self.bands = bands
+        self.weekend_bands = bands if weekend_bands is None else weekend_bands
+        self._weekday = self._changes(bands)
+        self._weekend = self._changes(self.weekend_bands)
+
+    def _changes(self, bands: list) -> tuple:
+        """Flatten the bands into (minutes, rates) where each rate applies from its minute."""
+        spans = []
+        for (start, end, rate) in bands:
+            (start, end) = (minute_of_day(start), minute_of_day(end))
+            if end < start:
+                spans += [(start, MINUTES_IN_DAY, rate), (0, end, rate)]
+            else:
+                spans.append((start, end, rate))
+        points = sorted({0} | {p for span in spans for p in span[:2] if p < MINUTES_IN_DAY})
+        minutes = []
+        rates = []
+        for point in points:
+            rate = self.default_rate
+            for (start, end, band_rate) in spans:
+                if start <= point < end:
+                    rate = band_rate
+            if rates == [] or rates[-1] != rate:
+                minutes.append(point)
+                rates.append(rate)
+        return (minutes, rates)
+
+    def _day(self, day: date) -> tuple:
+        return self._weekend if day.weekday() >= 5 else self._weekday
+
+    def price_at(self, when: datetime) -> float:
+        """The rate at a given time."""
+        (minutes, rates) = self._day(when.date())
+        return rates[bisect_right(minutes, when.hour * 60 + when.minute) - 1]
+
+    def changes(self, start: datetime, end: datetime) -> list:
+        """Get the (time, rate) at start and every change of rate after it, before end."""
+        schedule = [(start, self.price_at(start))]
+        day = start.date()
+        while datetime.combine(day, time()) < end:
+            (minutes, rates) = self._day(day)
+            for (minute, rate) in zip(minutes, rates):
+                when = datetime.combine(day, time()) + timedelta(minutes=minute)
+                if start < when < end and rate != schedule[-1][1]:
+                    schedule.append((when, rate))
+            day += timedelta(days=1)
+        return schedule
+
+    def next_change(self, when: datetime):
+        """Get the (time, rate) of the next change of rate within a week, or None."""
+        rate = self.price_at(when)
+        day = when.date()
+        i = bisect_right(self._day(day)[0], when.hour * 60 + when.minute)
+        for _ in range(8):
+            (minutes, rates) = self._day(day)
+            # Consecutive rates always differ, so this only looks past i at the start of a day
+            for j in range(i, len(minutes)):
+                if rates[j] != rate:
+                    return (datetime.combine(day, time()) + timedelta(minutes=minutes[j]), rates[j])
+            day += timedelta(days=1)
+            i = 0
+        return None
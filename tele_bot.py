@@ -1,20 +1,28 @@
 """Contains the class that handles anything to do with the telegram bot."""
+from concurrent.futures import TimeoutError
 from config import Config
 from datalogger import DataLogger
-from handlers import ChangeHandler, LiveStatusHandler
+from handlers import ChangeHandler, HandlerRegistry, LiveStatusHandler
 from nvi import NonVolatileInformation
+from outbox import Outbox
 from pathlib import Path
 from state import Mode, Modes
 from telegram import Update
-from telegram.error import NetworkError
 from telegram.ext import (CallbackQueryHandler, CommandHandler, MessageHandler,
                           Updater, CallbackContext, Filters)
 from quasar import Quasar
 
+# How long a reply may take to be sent before giving up on waiting for it
+REPLY_TIMEOUT = 30
+
 class Info:
+    """The latest state, version goes up every time an update changes it."""
+
     def __init__(self):
         self.info = {}
         self.last_info = {}
+        self.changed = []
+        self.version = 0
 
     def get(self, *items, require=False):
         stuff = [self.info.get(item) for item in items]
@@ -26,6 +34,11 @@ class Info:
     def update(self, new_info: dict):
         self.last_info = self.info
         self.info = new_info
+        last = self.last_info
+        self.changed = [k for (k, v) in new_info.items() if k not in last or last[k] != v]
+        self.changed += [k for k in last if k not in new_info]
+        if self.changed != []:
+            self.version += 1
 
     def item_has_changed(self, item: str):
         return self.info.get(item) != self.last_info.get(item)
@@ -52,6 +65,8 @@ class TelegramBot:
         self.datalogger = datalogger
         self.quasar = quasar
         self.logger = config.logger
+        self.outbox = Outbox(self.logger)
+        self.outbox.start()
         self.nvinfo = NonVolatileInformation(config.path / Path('telegram_info.json'))
         self.modes = Modes(config, start_mode, self.nvinfo, quasar)
         self.updater = Updater(self.nvinfo.token)
@@ -60,8 +75,9 @@ class TelegramBot:
         self.dispatcher.add_error_handler(self.error_handler)
         self.dispatcher.add_handler(
             MessageHandler(Filters.text & (~Filters.command), self.message_handler))
-        self.change_handlers = []
+        self.change_handlers = HandlerRegistry()
         self.info = Info()
+        self._formatted = (None, {})
         self.last_settings = {}
         self.updater.start_polling()
         self.particular_message_handler = None
@@ -89,11 +105,11 @@ class TelegramBot:
                 return default
 
     def add_handler(self, handler: ChangeHandler):
-        self.change_handlers.append(handler)
+        self.change_handlers.add(handler)
 
-    def remove_handler(self, handler):
-        handler.remove()
-        del self.change_handlers[self.change_handlers.index(handler)]
+    def remove_handler(self, handler: ChangeHandler):
+        if self.change_handlers.remove(handler):
+            handler.remove()
 
     def get_chat_id(self, update: Update):
         if update.effective_chat is not None:
@@ -101,53 +117,65 @@ class TelegramBot:
         else:
             raise TypeError('update.effective_chat is None')
 
-    def _send(self, command, *args, mes_id = False, **kwargs):
+    def reply_text(self, update: Update, text: str, timeout: float = REPLY_TIMEOUT,
+                   **kwargs) -> int:
+        """Reply with a text message, waiting at most timeout seconds for it to be sent."""
+        future = self.outbox.send(self.get_chat_id(update), update.message.reply_text, text=text,
+                                  **kwargs)
         try:
-            self.logger.info(f'{command}({", ".join(map(str, args))}, {kwargs})')
-            ret = command(*args, **kwargs)
-            if mes_id:
-                if ret is not None:
-                    return ret.message_id
-                else:
-                    raise TypeError('Expected message id')
-            else:
-                return ret
-        except NetworkError:
-            self.logger.warning('Network Error')
-        except:  # noqa
-            self.logger.exception('Telegram Bot:')
-
-    def reply_text(self, update: Update, text: str, **kwargs) -> int:
-        """Reply with a text message, with error handling."""
-        ret = self._send(update.message.reply_text, text, **kwargs, mes_id = True)
-        if isinstance(ret, int):
-            return ret
-        else:
-            raise TypeError('Unreachable')
+            mes = future.result(timeout)
+        except TimeoutError:
+            mes = None
+        if mes is None:
+            raise TypeError('Expected message id')
+        return mes.message_id
 
     def reply_document(self, update: Update, filepath: Path, **kwargs):
-        """Reply with a document from a particular filepath."""
-        return self._send(update.message.reply_document, open(filepath, 'rb'), **kwargs)
+        """Queue a reply with the document at filepath, giving a Future of the Message."""
+        def reply_document(**kwargs):
+            # Opened for each attempt, so a retry sends the whole file again
+            with open(filepath, 'rb') as fp:
+                return update.message.reply_document(fp, filename=filepath.name, **kwargs)
+        return self.outbox.send(self.get_chat_id(update), reply_document, **kwargs)
+
+    def reply_photo(self, update: Update, photo: bytes, **kwargs):
+        """Queue a reply with an image, giving a Future of the Message."""
+        return self.outbox.send(self.get_chat_id(update), update.message.reply_photo,
+                                photo=photo, **kwargs)
 
     def send_text(self, text: str, chat_id: int, silent=False, **kwargs):
-        """Send a text message to a given chat."""
-        return self._send(self.updater.bot.send_message, chat_id, text,
-                          disable_notification=silent, **kwargs)
-
-    def edit_message_text(self, text: str, chat_id: int, mes_id: int, **kwargs):
-        """Edit a given message."""
-        return self._send(self.updater.bot.edit_message_text, text, chat_id, mes_id, **kwargs)
-
-    def delete_message(self, chat_id: int, mes_id: int, **kwargs):
-        """Delete a given message."""
-        return self._send(self.updater.bot.delete_message, chat_id, mes_id, **kwargs)
+        """Queue a text message to a given chat, giving a Future of the Message."""
+        return self.outbox.send(chat_id, self.updater.bot.send_message, chat_id=chat_id,
+                                text=text, disable_notification=silent, **kwargs)
+
+    def edit_message_text(self, text: str, chat_id: int, mes_id, **kwargs):
+        """Queue an edit of a given message, by id or the Future send_text gave."""
+        return self.outbox.edit(chat_id, mes_id, self.updater.bot.edit_message_text,
+                                chat_id=chat_id, text=text, **kwargs)
+
+    def delete_message(self, chat_id: int, mes_id, **kwargs):
+        """Queue deleting a given message, by id or the Future send_text gave."""
+        return self.outbox.delete(chat_id, mes_id, self.updater.bot.delete_message,
+                                  chat_id=chat_id, **kwargs)
+
+    def formatted_current(self, rounding: int = 1, kw: bool = False) -> str:
+        """The info as text, only formatted again once the info has changed."""
+        (version, formatted) = self._formatted
+        if version != self.info.version:
+            formatted = {}
+            self._formatted = (self.info.version, formatted)
+        message = formatted.get((rounding, kw))
+        if message is None:
+            message = formatted[(rounding, kw)] = self._format_current(rounding, kw)
+        return message
 
-    def formatted_current(self, rounding: int = 1, kw: bool = False):
-        info = self.info.get('currents', 'estimated', 'recommended', 'charge_rate', require=True)
+    def _format_current(self, rounding: int, kw: bool) -> str:
+        info = self.info.get('currents', 'estimated', 'recommended', 'charge_rate', 'soc',
+                             require=True)
         if info is None:
             message = 'N/A'
         else:
-            (currents, estimated, recommended, charge_rate) = info
+            (currents, estimated, recommended, charge_rate, soc) = info
             if kw:
                 multiplier = 0.24
                 symbol = 'kW'
@@ -163,20 +191,25 @@ class TelegramBot:
                 message.append(f'{round(estimated, rounding)}A: Estimated')
                 message.append(f'{recommended}A: Recommended')
                 message.append(f'{charge_rate}A: Charge Rate')
-                soc = self.quasar.soc
                 if soc == 0:
                     message.append('?%: State of Charge')
                 else:
-                    message.append(f'{self.quasar.soc}%: State of Charge')
+                    message.append(f'{soc}%: State of Charge')
             message = '\n'.join(message)
         return message
 
-    def update_info(self, currents: list, estimated: float, recommended: int, charge_rate: int):
-        """Update what it knows about the state."""
+    def update_info(self, currents: list, estimated: float, recommended: int, charge_rate: int,
+                    soc: int):
+        """Update what it knows about the state.
+
+        soc is the one the charger thread last read, so this never waits on Modbus.
+        """
         self.info.update({'currents': currents, 'estimated': estimated,
-                          'recommended': recommended, 'charge_rate': charge_rate})
-        for handler in self.change_handlers:
-            if handler.should_update():
+                          'recommended': recommended, 'charge_rate': charge_rate,
+                          'soc': soc, 'mode': self.modes._mode})
+        for handler in self.change_handlers.watching(self.info.changed):
+            # It may have been removed since watching was called
+            if handler in self.change_handlers and handler.should_update():
                 if handler.update() is False:
                     self.remove_handler(handler)
 
@@ -196,10 +229,7 @@ class TelegramBot:
     def update_settings(self, update: Update):
         chat_id = self.get_chat_id(update)
         if self.last_settings.get(chat_id) is not None:
-            mes = self.send_text(self.settings_text(), chat_id)
-            if mes is None:
-                raise TypeError('Expected message id')
-            mes_id = mes.message_id
+            mes_id = self.send_text(self.settings_text(), chat_id)
             self.delete_message(chat_id, self.last_settings[chat_id])
             self.last_settings[chat_id] = mes_id
 
@@ -341,3 +371,5 @@ class TelegramBot:
         """Kills all handlers."""
         for handler in self.change_handlers:
             self.remove_handler(handler)
+        self.outbox.stop()
+        self.nvinfo.flush()
@@ -0,0 +1,57 @@
+"""Check batch gives exactly what the scalar pipeline does, in every mode."""
+import batch
+from config import Config
+import numpy as np
+from parity import TYPES, make_config, replay, samples
+from pathlib import Path
+import pytest
+from state import Mode
+
+SETTINGS = [{},
+            {'charge_cost_limit': 8.0, 'discharge_value': 20.0, 'min_discharge_rate': 6},
+            {'charge_cost_limit': 10.0, 'max_paid_soc': 60, 'min_discharge_soc': 30},
+            {'charge_cost_limit': 40.0, 'discharge_value': 5.0, 'max_paid_soc': -1,
+             'min_discharge_soc': -1}]
+SAMPLES = 20000
+
+
+def check(expected: tuple, config: Config, policy, currents, times, socs):
+    estimated = batch.current_combine(currents, TYPES)
+    price = batch.prices(config, times)
+    recommended = batch.recommend(estimated, price, socs, policy)
+    actual = (estimated, price, recommended, batch.on_off(recommended, 4))
+    for (name, e, a) in zip(['current_combine', 'prices', 'recommend', 'on_off'], expected,
+                            actual):
+        mismatches = np.flatnonzero(np.asarray(e) != a)
+        assert len(mismatches) == 0, f'{name} differs at {len(mismatches)} samples, first \
+{mismatches[0] if len(mismatches) > 0 else None}'
+
+
+@pytest.mark.parametrize('settings', SETTINGS)
+@pytest.mark.parametrize('mode', [Mode.OFF, Mode.CHARGE_ONLY, Mode.CHARGE_DISCHARGE,
+                                  Mode.MAX_CHARGE])
+def test_parity(tmp_path: Path, mode: Mode, settings: dict):
+    (currents, times, socs) = samples(SAMPLES)
+    (expected, config, policy) = replay(tmp_path, mode, settings, currents, times, socs)
+    check(expected, config, policy, currents, times, socs)
+
+
+def test_parity_auto(tmp_path: Path):
+    # At or below min_charge AUTO switches to its winter policy part way through, which batch
+    # can't follow, so keep the SoC above it
+    (currents, times, socs) = samples(SAMPLES, make_config(tmp_path).min_charge + 1)
+    (expected, config, policy) = replay(tmp_path, Mode.AUTO, {}, currents, times, socs)
+    check(expected, config, policy, currents, times, socs)
+
+
+@pytest.mark.parametrize('settings', SETTINGS)
+def test_soc_limits(tmp_path: Path, settings: dict):
+    # Every SoC, so each boundary is checked on both sides
+    (_, config, policy) = replay(tmp_path, Mode.CHARGE_DISCHARGE, settings, np.zeros((0, 5)),
+                                 np.zeros(0), np.zeros(0))
+    socs = np.arange(0, 101)
+    for estimated in (1.0, 5.0):
+        assert batch.charge_limits(policy, socs).tolist() == \
+            [policy.charge_limit(soc) for soc in socs.tolist()]
+        assert batch.discharge_limits(policy, np.full(101, estimated), socs).tolist() == \
+            [policy.discharge_limit(estimated, soc) for soc in socs.tolist()]
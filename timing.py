@@ -1,15 +1,116 @@
+"""Where the time comes from, so it can be fixed or sped up for simulations and soak tests."""
 from datetime import datetime
-import time
+import time as _time
+
+# How long a tick's reading of the clock is used for before now() reads it again
+MAX_TICK_AGE = 1.0
+
+
+class Clock:
+    """The wall clock, with time() for timestamps and monotonic() for measuring intervals."""
+
+    def time(self) -> float:
+        return _time.time()
+
+    def monotonic(self) -> float:
+        return _time.monotonic()
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.time())
+
+
+class FixedClock(Clock):
+    """Stays at a time until it is set or advanced, monotonic() only counts moves forward."""
+
+    def __init__(self, when: float = 0.0):
+        self._when = when
+        self._now = datetime.fromtimestamp(when)
+        self._elapsed = 0.0
+
+    def set(self, when: float):
+        self._elapsed += max(when - self._when, 0.0)
+        self._when = when
+        self._now = datetime.fromtimestamp(when)
+
+    def advance(self, seconds: float):
+        self.set(self._when + seconds)
+
+    def time(self) -> float:
+        return self._when
+
+    def monotonic(self) -> float:
+        return self._elapsed
+
+    def now(self) -> datetime:
+        return self._now
+
+
+class AcceleratedClock(Clock):
+    """Runs factor times faster than the wall clock, from start (or now if it is None)."""
+
+    def __init__(self, factor: float, start: float = None):
+        self.factor = factor
+        self._start = _time.time() if start is None else start
+        self._origin = _time.monotonic()
+
+    def time(self) -> float:
+        return self._start + self.monotonic()
+
+    def monotonic(self) -> float:
+        return (_time.monotonic() - self._origin) * self.factor
+
+
+_clock = Clock()
+# (monotonic, datetime) of the last tick
+_tick = None
+
+
+def set_clock(clock: Clock = None):
+    """Use clock for everything, or the wall clock if it is None."""
+    global _clock, _tick
+    _clock = Clock() if clock is None else clock
+    _tick = None
+
+
+def clock() -> Clock:
+    return _clock
+
+
+def tick() -> datetime:
+    """Read the clock once for this pass of the loop, now() then gives the same reading until
+    the next tick or until it is MAX_TICK_AGE old."""
+    global _tick
+    _tick = (_clock.monotonic(), _clock.now())
+    return _tick[1]
+
+
+def now() -> datetime:
+    tick = _tick
+    if tick is not None and _clock.monotonic() - tick[0] < MAX_TICK_AGE:
+        return tick[1]
+    return _clock.now()
+
+
+def time() -> float:
+    return _clock.time()
+
+
+def monotonic() -> float:
+    return _clock.monotonic()
+
 
 def past_this_time(time: tuple) -> bool:
-    now = datetime.now()
-    return (time[0] == now.hour and time[1] <= now.minute) or time[0] < now.hour
+    when = now()
+    return (time[0] == when.hour and time[1] <= when.minute) or time[0] < when.hour
+
 
 def comparison_day_number() -> int:
-    return datetime.now().day
+    return now().day
+
 
 def day_number() -> int:
-    return int((time.time() + 3600) // 86400)
+    return int((now().timestamp() + 3600) // 86400)
+
 
 def second_number() -> int:
-    return int(time.time())
+    return int(now().timestamp())